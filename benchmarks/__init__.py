@@ -0,0 +1,5 @@
+"""
+Benchmarks for mreg. Run them from the top directory, e.g.
+
+    DJANGO_SETTINGS_MODULE=mregsite.settings python -m benchmarks.zonefile
+"""
@@ -0,0 +1,152 @@
+"""
+Synthetic data for benchmarks, shaped like a large site.
+
+generate() fills the database with the given number of forward zones and
+hosts, using bulk inserts, so no signals are run and the zones are set
+directly. The data is the same on every run for the same arguments:
+
+- host{i}.zone{i % zones}.example.org, with an IPv4 address in 10.0.0.0/8,
+  200 hosts per /24 network. Three of four have a MAC address.
+- Every second host has an IPv6 address in 2001:db8::/32, one /64 network
+  per /24 network.
+- Every fifth host has a cname, every tenth a mx, every fourth a txt,
+  every 50th a srv and every 100th a naptr record.
+- Every 50th host shares the IPv4 address of the previous host, with a
+  PtrOverride for the previous host.
+- One reverse zone for all the IPv4 addresses and one for all the IPv6
+  addresses.
+"""
+import ipaddress
+
+HOSTS_PER_NETWORK = 200
+FIRST_HOST = 10
+NAMESERVERS = ('ns1.example.org', 'ns2.example.org')
+REVERSE_ZONES = ('10.in-addr.arpa', '8.b.d.0.1.0.0.2.ip6.arpa')
+
+_V4_BASE = int(ipaddress.ip_address('10.0.0.0'))
+_V6_BASE = int(ipaddress.ip_address('2001:db8::'))
+
+
+def zone_name(z):
+    return f'zone{z}.example.org'
+
+
+def host_name(i, zones):
+    return f'host{i}.{zone_name(i % zones)}'
+
+
+def ipv4_network(n):
+    return ipaddress.ip_network(_V4_BASE + (n << 8)).supernet(new_prefix=24)
+
+
+def ipv6_network(n):
+    return ipaddress.ip_network(_V6_BASE + (n << 64)).supernet(new_prefix=64)
+
+
+def _host_offset(i):
+    return i // HOSTS_PER_NETWORK, FIRST_HOST + i % HOSTS_PER_NETWORK
+
+
+def ipv4_address(i):
+    n, offset = _host_offset(i)
+    return ipv4_network(n)[offset]
+
+
+def ipv6_address(i):
+    n, offset = _host_offset(i)
+    return ipv6_network(n)[offset]
+
+
+def mac_address(i):
+    return '02:00:' + ':'.join(f'{b:02x}' for b in i.to_bytes(4, 'big'))
+
+
+def _make_zones(zones):
+    from mreg.models import ForwardZone, NameServer, ReverseZone
+    from mreg.utils import get_network_from_zonename
+
+    NameServer.objects.bulk_create([NameServer(name=name) for name in NAMESERVERS])
+    ForwardZone.objects.bulk_create([
+        ForwardZone(name=zone_name(z), primary_ns=NAMESERVERS[0], email='hostmaster@example.org')
+        for z in range(zones)])
+    ReverseZone.objects.bulk_create([
+        ReverseZone(name=name, range=str(get_network_from_zonename(name)),
+                    primary_ns=NAMESERVERS[0], email='hostmaster@example.org')
+        for name in REVERSE_ZONES])
+
+    nameservers = list(NameServer.objects.filter(name__in=NAMESERVERS))
+    for model in (ForwardZone, ReverseZone):
+        through = model.nameservers.through
+        through.objects.bulk_create([
+            through(**{f'{model._meta.model_name}_id': zone_id, 'nameserver_id': ns.id})
+            for zone_id in model.objects.values_list('id', flat=True)
+            for ns in nameservers])
+
+
+def generate(zones=10, hosts=10000):
+    """Fill the database with the synthetic data and return the number of
+    rows created per model."""
+    from mreg.models import (Cname, ForwardZone, Host, Ipaddress, Mx, Naptr,
+                             Network, PtrOverride, Srv, Txt)
+
+    _make_zones(zones)
+    zone_ids = dict(ForwardZone.objects.values_list('name', 'id'))
+
+    Host.objects.bulk_create([
+        Host(name=host_name(i, zones), zone_id=zone_ids[zone_name(i % zones)],
+             contact='hostmaster@example.org', ttl=None if i % 3 else 3600)
+        for i in range(hosts)], batch_size=1000)
+    host_ids = dict(Host.objects.values_list('name', 'id'))
+
+    ipaddresses = []
+    ptr_overrides = []
+    cnames = []
+    mxs = []
+    txts = []
+    srvs = []
+    naptrs = []
+    for i in range(hosts):
+        name = host_name(i, zones)
+        host_id = host_ids[name]
+        zone_id = zone_ids[zone_name(i % zones)]
+        ipaddresses.append(Ipaddress(host_id=host_id, ipaddress=str(ipv4_address(i)),
+                                     macaddress=mac_address(i) if i % 4 else ''))
+        if i % 2 == 0:
+            ipaddresses.append(Ipaddress(host_id=host_id, ipaddress=str(ipv6_address(i))))
+        if i % 50 == 1:
+            shared = str(ipv4_address(i - 1))
+            ipaddresses.append(Ipaddress(host_id=host_id, ipaddress=shared))
+            ptr_overrides.append(PtrOverride(host_id=host_ids[host_name(i - 1, zones)],
+                                             ipaddress=shared))
+        if i % 5 == 0:
+            cnames.append(Cname(host_id=host_id, zone_id=zone_id,
+                                name=f'alias{i}.{zone_name(i % zones)}'))
+        if i % 10 == 0:
+            mxs.append(Mx(host_id=host_id, priority=10, mx=f'mx{i % 3}.example.org'))
+        if i % 4 == 0:
+            txts.append(Txt(host_id=host_id, txt=f'v=spf1 ip4:{ipv4_address(i)} -all'))
+        if i % 50 == 0:
+            srvs.append(Srv(zone_id=zone_id, name=f'_http._tcp.{zone_name(i % zones)}',
+                            priority=10, weight=5, port=80, target=name))
+        if i % 100 == 0:
+            naptrs.append(Naptr(host_id=host_id, preference=10, order=100, flag='s',
+                                service='SIP+D2U', regex='',
+                                replacement=f'_sip._udp.{zone_name(i % zones)}'))
+
+    networks = []
+    for n in range((hosts + HOSTS_PER_NETWORK - 1) // HOSTS_PER_NETWORK):
+        networks.append(Network(range=str(ipv4_network(n)), description=f'Network {n}',
+                                vlan=n % 4096, dns_delegated=False))
+        networks.append(Network(range=str(ipv6_network(n)), description=f'Network {n}',
+                                vlan=n % 4096, dns_delegated=False))
+
+    ret = {}
+    for model, objects in ((Ipaddress, ipaddresses), (PtrOverride, ptr_overrides),
+                           (Cname, cnames), (Mx, mxs), (Txt, txts), (Srv, srvs),
+                           (Naptr, naptrs), (Network, networks)):
+        model.objects.bulk_create(objects, batch_size=1000)
+        ret[model.__name__] = len(objects)
+    ret['ForwardZone'] = zones
+    ret['ReverseZone'] = len(REVERSE_ZONES)
+    ret['Host'] = hosts
+    return ret
@@ -0,0 +1,179 @@
+"""
+Benchmark of the API endpoints on a synthetic large site.
+
+Creates a test database, fills it using benchmarks.data, and times each of
+the requests below, repeated --repeat times. The zonefiles are removed from
+the zonefile cache before each request, so they are rendered every time.
+ZONEFILE_ARTIFACT_DIR is unset while benchmarking, so no published
+zonefiles are served instead.
+
+The results are written as JSON to --output, with the commit, the data
+sizes and for each benchmark the timings, the number of SQL queries and
+the size of the response, so they can be compared between commits.
+"""
+import argparse
+import itertools
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import django
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _get_client():
+    from django.conf import settings
+    from django.contrib.auth.models import Group, User
+    from rest_framework.authtoken.models import Token
+    from rest_framework.test import APIClient
+
+    user = User.objects.create(username='benchmark')
+    token = Token.objects.create(user=user)
+    group_name = getattr(settings, 'REQUIRED_USER_GROUP', None)
+    if group_name is not None:
+        group, created = Group.objects.get_or_create(name=group_name)
+        group.user_set.add(user)
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+    return client
+
+
+def _clear_zonefile(name):
+    from mreg.publish import _get_cache, _get_current_key
+
+    _get_cache().delete(_get_current_key(name))
+
+
+def get_benchmarks():
+    """Return a list of (name, method, path function, data function,
+    setup function). The path and data functions are given the number of
+    the repetition."""
+    from benchmarks.data import REVERSE_ZONES, ipv4_network, zone_name
+
+    forward = zone_name(0)
+    reverse_v4, reverse_v6 = REVERSE_ZONES
+    network = ipv4_network(0)
+
+    def zonefile(name):
+        return (f'zonefile {name}', 'get', lambda n: f'/zonefiles/{name}', None,
+                lambda: _clear_zonefile(name))
+
+    def create_data(n):
+        return {'name': f'bench-create-{n}.{forward}',
+                'ipaddress': f'10.255.{n // 250}.{n % 250 + 1}',
+                'contact': 'hostmaster@example.org'}
+
+    return [
+        ('host list', 'get', lambda n: '/hosts/', None, None),
+        ('host list 1000', 'get', lambda n: '/hosts/?page_size=1000', None, None),
+        ('host create', 'post', lambda n: '/hosts/', create_data, None),
+        zonefile(forward),
+        zonefile(reverse_v4),
+        zonefile(reverse_v6),
+        ('network unused list', 'get',
+         lambda n: f'/networks/{network.network_address}/{network.prefixlen}/unused_list',
+         None, None),
+        ('dhcphosts v4', 'get', lambda n: '/dhcphosts/v4/all', None, None),
+        ('dhcphosts v6', 'get', lambda n: '/dhcphosts/v6/all', None, None),
+        ('dhcphosts v6byv4', 'get', lambda n: '/dhcphosts/v6byv4/', None, None),
+    ]
+
+
+def run_benchmark(client, method, path, data, setup, repeat, counter):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    timings = []
+    for _ in range(repeat):
+        n = next(counter)
+        if setup is not None:
+            setup()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            if data is None:
+                response = getattr(client, method)(path(n))
+            else:
+                response = getattr(client, method)(path(n), data(n), format='json')
+            if response.streaming:
+                size = sum(len(i) for i in response.streaming_content)
+            else:
+                size = len(response.content)
+            timings.append(time.perf_counter() - start)
+    return {'status': response.status_code,
+            'queries': len(queries),
+            'bytes': size,
+            'min': min(timings),
+            'median': statistics.median(timings),
+            'max': max(timings),
+            'timings': timings}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--zones', type=int, default=10)
+    parser.add_argument('--hosts', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--only', action='append',
+                        help='Only run the named benchmark, may be repeated')
+    args = parser.parse_args()
+
+    django.setup()
+    from django.db import connection
+    from django.test.utils import (override_settings, setup_test_environment,
+                                   teardown_test_environment)
+
+    from benchmarks.data import generate
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    no_artifacts = override_settings(ZONEFILE_ARTIFACT_DIR=None)
+    no_artifacts.enable()
+    try:
+        start = time.perf_counter()
+        counts = generate(zones=args.zones, hosts=args.hosts)
+        generate_time = time.perf_counter() - start
+        print(f'{"generate":24} {generate_time:10.3f} s')
+
+        client = _get_client()
+        counter = itertools.count()
+        results = {}
+        for name, method, path, data, setup in get_benchmarks():
+            if args.only and name not in args.only:
+                continue
+            result = run_benchmark(client, method, path, data, setup, args.repeat, counter)
+            results[name] = result
+            print(f'{name:24} {result["median"]:10.3f} s {result["queries"]:6} queries '
+                  f'{result["bytes"]:10} bytes  status {result["status"]}')
+    finally:
+        no_artifacts.disable()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    output = {'commit': _get_commit(),
+              'timestamp': time.time(),
+              'python': platform.python_version(),
+              'django': django.get_version(),
+              'database': connection.vendor,
+              'arguments': vars(args),
+              'counts': counts,
+              'generate': generate_time,
+              'benchmarks': results}
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+    print(f'Results written to {args.output}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
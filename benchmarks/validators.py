@@ -0,0 +1,42 @@
+"""
+Throughput benchmark of validate_hostname. Does not use the database.
+
+Validates a set of made up names, first uncached and then again with the
+names already validated, and prints names per second for both.
+"""
+import argparse
+import time
+
+import django
+
+
+def _run(label, func, names):
+    start = time.perf_counter()
+    for name in names:
+        func(name)
+    elapsed = time.perf_counter() - start
+    print(f'{label:10} {len(names) / elapsed:12.0f} names/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--names', type=int, default=50000)
+    args = parser.parse_args()
+
+    django.setup()
+    from mreg.validators import _validate_hostname, validate_hostname
+
+    names = []
+    for i in range(args.names):
+        if i % 10 == 0:
+            names.append(f'blåbær-{i}.example.org')
+        else:
+            names.append(f'host-{i}.sub{i % 100}.example.org')
+
+    _validate_hostname.cache_clear()
+    _run('uncached', validate_hostname, names)
+    _run('cached', validate_hostname, names)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Micro benchmark of the record formatting in the zonefile generation. Does not
+use the database, the records are made up and fed directly to ForwardFile.
+
+Prints the number of records formatted per second by ForwardFile, and by the
+previous formatting which built a dict and used a regex for each name.
+"""
+import argparse
+import ipaddress
+import re
+import time
+
+from collections import defaultdict
+
+import django
+
+
+def _old_qualify(name, zone):
+    if name.endswith(zone):
+        name = re.sub('(.?%s)$' % zone, '', name)
+    elif not name.endswith("."):
+        name += '.'
+    return name
+
+
+def _old_host_data(zonefile, host, idna_encode):
+    """The formatting of ForwardFile.host_data before the record formats."""
+    def ip_zf_string(name, ttl, ip):
+        data = {'name': name, 'ttl': ttl, 'record_type': "A" if ip.version == 4 else "AAAA",
+                'record_data': str(ip)}
+        return '{name:24} {ttl:5} IN {record_type:6} {record_data:39}\n'.format_map(data)
+
+    def mx_zf_string(name, ttl, priority, mx):
+        data = {'name': name, 'ttl': ttl, 'record_type': "MX", 'priority': priority,
+                'mx': idna_encode(_old_qualify(mx, zonefile.zone.name))}
+        return '{name:24} {ttl:5} IN {record_type} {priority:6} {mx:39}\n'.format_map(data)
+
+    def txt_zf_string(name, ttl, txt):
+        data = {'name': name, 'ttl': ttl, 'record_type': "TXT", 'record_data': f'"{txt}"'}
+        return '{name:24} {ttl:5} IN {record_type:6} {record_data:39}\n'.format_map(data)
+
+    data = ""
+    first = True
+    name_idna = idna_encode(_old_qualify(host.name, zonefile.zone.name))
+    ttl = "" if host.ttl is None else host.ttl
+    for values, func in ((zonefile.ipaddresses, ip_zf_string),
+                         (zonefile.mxs, mx_zf_string),
+                         (zonefile.txts, txt_zf_string)):
+        for i in values.get(host.name, ()):
+            if first:
+                first = False
+                name = name_idna
+            else:
+                name = ""
+            data += func(name, ttl, *i)
+    return data
+
+
+def _make_zonefile(hosts):
+    from mreg.api.v1.zonefile import ForwardFile
+    from mreg.models import ForwardZone, Host
+
+    zonefile = ForwardFile(ForwardZone(name='example.org'))
+    zonefile.host_cnames = defaultdict(list)
+    zonefile.ipaddresses = defaultdict(list)
+    zonefile.mxs = defaultdict(list)
+    zonefile.naptrs = defaultdict(list)
+    zonefile.txts = defaultdict(list)
+    network = ipaddress.ip_network('10.0.0.0/8')
+    records = 0
+    host_list = []
+    for i in range(hosts):
+        name = f'host{i}.example.org'
+        host_list.append(Host(name=name, ttl=None if i % 2 else 300))
+        zonefile.ipaddresses[name].append((network[i + 1],))
+        zonefile.mxs[name].append((10, 'mx.example.org'))
+        zonefile.txts[name].append((f'v=spf1 -all {i}',))
+        records += 3
+    return zonefile, host_list, records
+
+
+def _run(label, func, records):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f'{label:10} {records / elapsed:12.0f} records/s')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--hosts', type=int, default=50000)
+    args = parser.parse_args()
+
+    django.setup()
+    from mreg.utils import idna_encode
+
+    zonefile, hosts, records = _make_zonefile(args.hosts)
+
+    def old():
+        "".join(_old_host_data(zonefile, host, idna_encode) for host in hosts)
+
+    def new():
+        out = []
+        for host in hosts:
+            zonefile.host_data(host, out)
+        "".join(out)
+
+    before = _run('before', old, records)
+    after = _run('after', new, records)
+    print(f'speedup    {before / after:12.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,36 @@
 from django.conf import settings
+from django.core.cache import caches
 from rest_framework import exceptions
 from rest_framework.permissions import BasePermission
 
+from mreg.authentication import get_cache_timeout
+
+# The group names of each user are cached for GROUP_CACHE_TIMEOUT seconds in
+# the cache given by TOKEN_CACHE, and invalidated by signals when the user's
+# groups are changed. As for tokens, see mreg.authentication, entries in a
+# per process cache are kept for a short time only.
+GROUP_CACHE_TIMEOUT = getattr(settings, 'GROUP_CACHE_TIMEOUT', 60)
+
+
+def _get_cache():
+    return caches[getattr(settings, 'TOKEN_CACHE', 'default')]
+
+
+def get_user_groups(user):
+    """Return the names of the user's groups."""
+    key = f'groups:{user.id}'
+    groups = _get_cache().get(key)
+    if groups is None:
+        groups = frozenset(user.groups.values_list('name', flat=True))
+        cache = _get_cache()
+        cache.set(key, groups, get_cache_timeout(cache, GROUP_CACHE_TIMEOUT))
+    return groups
+
+
+def invalidate_user_groups(user_ids):
+    _get_cache().delete_many([f'groups:{i}' for i in user_ids])
+
+
 class IsInRequiredGroup(BasePermission):
     """
     Allows only access to users in the required group.
@@ -13,4 +42,4 @@ class IsInRequiredGroup(BasePermission):
         REQUIRED_USER_GROUP = getattr(settings, 'REQUIRED_USER_GROUP', None)
         if REQUIRED_USER_GROUP is None:
             raise exceptions.APIException(detail='REQUIRED_USER_GROUP is unset')
-        return request.user.groups.filter(name=REQUIRED_USER_GROUP).exists()
+        return REQUIRED_USER_GROUP in get_user_groups(request.user)
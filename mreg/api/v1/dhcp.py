@@ -0,0 +1,81 @@
+"""
+Rendering of the DHCP host exports in /dhcphosts/.
+
+The hosts are given as an iterator of (host name, IP address, MAC address),
+and rendered one host at a time by render_rows(), so the export can be
+streamed without building it in memory. The format is chosen with
+?format=json, which is the default, isc for ISC dhcpd host declarations or
+kea for Kea reservations.
+"""
+import json
+
+from rest_framework import renderers
+
+ISC_HOST_FORMAT = ('host "{name}_{ip}" {{\n'
+                   '    hardware ethernet {mac};\n'
+                   '    fixed-address {ip};\n'
+                   '    option host-name "{name}";\n'
+                   '}}\n').format
+ISC_HOST6_FORMAT = ('host "{name}_{ip}" {{\n'
+                    '    hardware ethernet {mac};\n'
+                    '    fixed-address6 {ip};\n'
+                    '}}\n').format
+
+
+class DhcpJSONRenderer(renderers.JSONRenderer):
+    """The hosts as a list of objects with host__name, ipaddress and
+    macaddress."""
+
+    def render_rows(self, rows):
+        yield '['
+        separator = ''
+        for name, ip, mac in rows:
+            yield separator + json.dumps({'host__name': name, 'ipaddress': ip,
+                                          'macaddress': mac})
+            separator = ','
+        yield ']'
+
+
+class IscDhcpRenderer(renderers.BaseRenderer):
+    """The hosts as ISC dhcpd host declarations. A host with several
+    addresses gets one declaration per address."""
+    media_type = 'text/plain'
+    format = 'isc'
+
+    def render(self, data, media_type=None, renderer_context=None):
+        # Only used for errors, the hosts are rendered by render_rows(). The
+        # error is given as comments, so that it is still a valid file.
+        if isinstance(data, dict):
+            lines = [f'{key}: {value}' for key, value in data.items()]
+        else:
+            lines = [str(data)]
+        return ''.join('# {}\n'.format(i.replace('\n', ' ')) for i in lines).encode(self.charset)
+
+    def render_rows(self, rows):
+        for name, ip, mac in rows:
+            if ':' in ip:
+                yield ISC_HOST6_FORMAT(name=name, ip=ip, mac=mac)
+            else:
+                yield ISC_HOST_FORMAT(name=name, ip=ip, mac=mac)
+
+
+class KeaDhcpRenderer(renderers.JSONRenderer):
+    """The hosts as a Kea "reservations" list, for the Dhcp4 or Dhcp6
+    configuration depending on the addresses."""
+    format = 'kea'
+
+    def render_rows(self, rows):
+        yield '{"reservations": ['
+        separator = ''
+        for name, ip, mac in rows:
+            reservation = {'hostname': name, 'hw-address': mac}
+            if ':' in ip:
+                reservation['ip-addresses'] = [ip]
+            else:
+                reservation['ip-address'] = ip
+            yield separator + json.dumps(reservation)
+            separator = ','
+        yield ']}'
+
+
+DHCP_RENDERERS = (DhcpJSONRenderer, IscDhcpRenderer, KeaDhcpRenderer)
@@ -1,5 +1,6 @@
 import ipaddress
 
+from django.db.models import Prefetch
 from django.utils import timezone
 from rest_framework import serializers
 
@@ -140,10 +141,20 @@ class HostSerializer(ForwardZoneMixin, serializers.ModelSerializer):
         fields = '__all__'
 
     def get_ipaddresses(self, instance):
-        ipaddresses = instance.ipaddresses.all().order_by('ipaddress')
+        # Already ordered if prefetched by prefetch_host_data()
+        if 'ipaddresses' in getattr(instance, '_prefetched_objects_cache', {}):
+            ipaddresses = instance.ipaddresses.all()
+        else:
+            ipaddresses = instance.ipaddresses.all().order_by('ipaddress')
         return IpaddressSerializer(ipaddresses, many=True, read_only=True).data
 
 
+def prefetch_host_data(qs):
+    """Prefetch the related data of the hosts used by HostSerializer, to
+    serialize many hosts with a fixed number of queries."""
+    ipaddresses = Prefetch('ipaddresses', queryset=Ipaddress.objects.order_by('ipaddress'))
+    return qs.prefetch_related(ipaddresses, 'cnames', 'mxs', 'txts', 'ptr_overrides')
+
 
 class HostSaveSerializer(ForwardZoneMixin, serializers.ModelSerializer):
     """
@@ -1,16 +1,35 @@
+import json
+import os
+import tempfile
+
 from datetime import timedelta
+from unittest import mock
 
 from django.conf import settings
 from django.contrib.auth.models import Group, User
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from rest_framework.authtoken.models import Token
-from rest_framework.test import APIClient, APITestCase
-
-from mreg.models import (Cname, HinfoPreset, Host, Ipaddress, NameServer,
-                         Naptr, PtrOverride, Srv, Network, Txt, ForwardZone,
-                         ReverseZone, ModelChangeLog)
-
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
+
+from mreg.models import (Cname, DhcpChange, HinfoPreset, Host, Ipaddress, Mx,
+                         NameServer, Naptr, PtrOverride, Srv, Network, Txt, ForwardZone,
+                         ForwardZoneDelegation, ReverseZone, ModelChangeLog)
+
+from benchmarks.data import (NAMESERVERS, REVERSE_ZONES, generate, ipv4_address,
+                             ipv4_network, zone_name)
+from mreg import metrics
+from mreg.api.v1.urls import urlpatterns
+from mreg.authentication import (LOCAL_CACHE_TIMEOUT, USER_FIELDS,
+                                 ExpiringTokenAuthentication, get_cache_timeout)
+from mreg.batch import bulk_operation, update_ptr_overrides
+from mreg.history import log_host_history
+from mreg.publish import publish_zones
 from mreg.utils import create_serialno
 
 def clean_and_save(entity):
@@ -337,6 +356,34 @@ class ModelPtrOverrideTestCase(TestCase):
         self.assertEqual(PtrOverride.objects.count(), 0)
         self.assertEqual(Ipaddress.objects.filter(ipaddress='10.0.0.1').count(), 2)
 
+    def test_model_bulk_ptroverrides(self):
+        """Adding ips in a bulk operation should give the same PtrOverrides as
+        adding them one by one."""
+        clean_and_save(Ipaddress(host=self.host_one, ipaddress='10.0.0.1'))
+        clean_and_save(Ipaddress(host=self.host_one, ipaddress='10.0.0.4'))
+        clean_and_save(Ipaddress(host=self.host_two, ipaddress='10.0.0.4'))
+        with bulk_operation():
+            added = [Ipaddress(host=self.host_two, ipaddress='10.0.0.1'),
+                     Ipaddress(host=self.host_two, ipaddress='10.0.0.5')]
+            update_ptr_overrides(removed=['10.0.0.4'], added=added)
+            Ipaddress.objects.filter(ipaddress='10.0.0.4', host=self.host_two).delete()
+            Ipaddress.objects.bulk_create(added)
+        ptrs = PtrOverride.objects.values_list('host', 'ipaddress')
+        self.assertEqual(list(ptrs), [(self.host_one.id, '10.0.0.1')])
+
+    def test_model_bulk_ptroverrides_same_batch(self):
+        """Two hosts getting the same new address in one bulk operation should
+        give the PtrOverride to the first, as when added one by one."""
+        with transaction.atomic(), bulk_operation():
+            added = [Ipaddress(host=self.host_one, ipaddress='10.0.0.7'),
+                     Ipaddress(host=self.host_two, ipaddress='10.0.0.7'),
+                     Ipaddress(host=self.host_two, ipaddress='10.0.0.8')]
+            update_ptr_overrides(added=added)
+            Ipaddress.objects.bulk_create(added)
+        ptrs = PtrOverride.objects.values_list('host', 'ipaddress')
+        self.assertEqual(list(ptrs), [(self.host_one.id, '10.0.0.7')])
+        self.assertEqual(Ipaddress.objects.filter(ipaddress='10.0.0.7').count(), 2)
+
 
 class ModelTxtTestCase(TestCase):
     """This class defines the test suite for the Txt model."""
@@ -584,9 +631,69 @@ class APITokenAutheticationTestCase(APITestCase):
         ret = self.client.get("/zones/")
         self.assertEqual(ret.status_code, 401)
 
+    def test_cached_token(self):
+        """A token should only be read from the database once."""
+        ret = self.client.get("/zones/")
+        self.assertEqual(ret.status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            ret = self.client.get("/zones/")
+        self.assertEqual(ret.status_code, 200)
+        self.assertFalse([i for i in queries.captured_queries if 'authtoken_token' in i['sql']])
+
+    def test_cached_token_user(self):
+        """A user read from the token cache should be the same as the one
+        read from the database."""
+        token = Token.objects.get(user__username='nobody')
+        auth = ExpiringTokenAuthentication()
+        user, _ = auth.authenticate_credentials(token.key)
+        with CaptureQueriesContext(connection) as queries:
+            cached, cached_token = auth.authenticate_credentials(token.key)
+        self.assertEqual(len(queries), 0)
+        for field in USER_FIELDS:
+            self.assertEqual(getattr(cached, field), getattr(user, field))
+        self.assertEqual(cached.username, 'nobody')
+        self.assertIs(cached.is_active, True)
+        self.assertIs(cached.is_superuser, False)
+        self.assertFalse(cached._state.adding)
+        self.assertEqual(cached_token.created, token.created)
+
+    def test_cached_groups(self):
+        """Group membership should be cached, but not after a change."""
+        ret = self.client.get("/zones/")
+        self.assertEqual(ret.status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            ret = self.client.get("/zones/")
+        self.assertEqual(ret.status_code, 200)
+        self.assertFalse([i for i in queries.captured_queries if 'auth_user_groups' in i['sql']])
+        User.objects.get(username='nobody').groups.clear()
+        ret = self.client.get("/zones/")
+        self.assertEqual(ret.status_code, 403)
+
+    def test_cached_groups_group_changed(self):
+        """Group membership should not be cached after the members of a group
+        are cleared, or the group is deleted."""
+        group = Group.objects.get(name=settings.REQUIRED_USER_GROUP)
+        ret = self.client.get("/zones/")
+        self.assertEqual(ret.status_code, 200)
+        group.user_set.clear()
+        ret = self.client.get("/zones/")
+        self.assertEqual(ret.status_code, 403)
+        group.user_set.add(User.objects.get(username='nobody'))
+        ret = self.client.get("/zones/")
+        self.assertEqual(ret.status_code, 200)
+        group.delete()
+        ret = self.client.get("/zones/")
+        self.assertEqual(ret.status_code, 403)
+
+    def test_local_cache_timeout(self):
+        """Tokens and groups should only be cached for a short time in a per
+        process cache, which other processes cannot invalidate."""
+        self.assertEqual(get_cache_timeout(LocMemCache('test', {}), 60), LOCAL_CACHE_TIMEOUT)
+        self.assertEqual(get_cache_timeout(DummyCache('test', {}), 60), 60)
+
 
 
-class APIAutoupdateZonesTestCase(APITestCase):
+class APIAutoupdateZonesTestCase(APITransactionTestCase):
     """This class tests the autoupdate of zones' updated_at whenever
        various models are added/deleted/renamed/changed etc."""
 
@@ -890,7 +997,109 @@ class APIHostsTestCase(TestCase):
         self.assertEqual(response.status_code, 409)
 
 
-class APIMxTestcase(APITestCase):
+class APIHostsBulkTestCase(APITestCase):
+    """This class defines the test suite for api/hosts/bulk and
+       api/hosts/bulk_delete"""
+
+    def setUp(self):
+        self.client = get_token_client()
+        self.zone_org = ForwardZone(name='example.org',
+                                    primary_ns='ns1.example.org',
+                                    email='hostmaster@example.org')
+        self.zone_1010 = ReverseZone(name='10.10.in-addr.arpa',
+                                     primary_ns='ns1.example.org',
+                                     email='hostmaster@example.org')
+        clean_and_save(self.zone_org)
+        clean_and_save(self.zone_1010)
+        for i in range(1, 4):
+            self.client.post('/hosts/', {'name': f'host{i}.example.org',
+                                         'ipaddress': f'10.10.0.{i}',
+                                         'contact': 'mail@example.org'})
+        self.client.post('/zones/', {'name': 'example.com',
+                                     'primary_ns': 'host3.example.org',
+                                     'email': 'hostmaster@example.org'})
+        for zone in (self.zone_org, self.zone_1010):
+            zone.refresh_from_db()
+            zone.updated = False
+            zone.save()
+
+    def test_bulk_delete_204_no_content(self):
+        names = ['host1.example.org', 'host2.example.org']
+        old_logs = ModelChangeLog.objects.count()
+        response = self.client.post('/hosts/bulk_delete', {'names': names})
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Host.objects.filter(name__in=names).exists())
+        self.assertFalse(Ipaddress.objects.filter(ipaddress__in=['10.10.0.1', '10.10.0.2']).exists())
+        self.assertEqual(ModelChangeLog.objects.count(), old_logs + 2)
+        self.zone_org.refresh_from_db()
+        self.zone_1010.refresh_from_db()
+        self.assertTrue(self.zone_org.updated)
+        self.assertTrue(self.zone_1010.updated)
+
+    def test_bulk_delete_by_filter_204_no_content(self):
+        response = self.client.post('/hosts/bulk_delete?name__startswith=host1')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(Host.objects.count(), 2)
+
+    def test_bulk_delete_nameserver_403_forbidden(self):
+        names = ['host1.example.org', 'host3.example.org']
+        response = self.client.post('/hosts/bulk_delete', {'names': names})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(Host.objects.filter(name__in=names).count(), 2)
+
+    def test_bulk_delete_unknown_404_not_found(self):
+        names = ['host1.example.org', 'nonexisting.example.org']
+        response = self.client.post('/hosts/bulk_delete', {'names': names})
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(Host.objects.filter(name='host1.example.org').exists())
+
+    def test_bulk_delete_without_selection_400_bad_request(self):
+        response = self.client.post('/hosts/bulk_delete')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Host.objects.count(), 3)
+
+    def test_bulk_delete_misspelled_filter_400_bad_request(self):
+        """An unknown filter should not be ignored, selecting all hosts"""
+        response = self.client.post('/hosts/bulk_delete?nmae=host1.example.org')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/hosts/bulk_delete?name__startswith=host1&nmae=host1')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Host.objects.count(), 3)
+
+    def test_bulk_delete_page_only_400_bad_request(self):
+        response = self.client.post('/hosts/bulk_delete?page=2')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/hosts/bulk_delete?name__contains=')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Host.objects.count(), 3)
+
+    def test_bulk_patch_unknown_filter_400_bad_request(self):
+        response = self.client.patch('/hosts/bulk?page=2', {'ttl': 3000})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.patch('/hosts/bulk?nmae=host1.example.org', {'ttl': 3000})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Host.objects.filter(ttl=3000).exists())
+
+    def test_bulk_patch_204_no_content(self):
+        names = ['host1.example.org', 'host2.example.org']
+        response = self.client.patch('/hosts/bulk', {'names': names, 'ttl': 3000})
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(Host.objects.filter(ttl=3000).count(), 2)
+        self.zone_org.refresh_from_db()
+        self.assertTrue(self.zone_org.updated)
+
+    def test_bulk_patch_name_403_forbidden(self):
+        response = self.client.patch('/hosts/bulk', {'names': ['host1.example.org'],
+                                                     'name': 'new.example.org'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_bulk_patch_invalid_400_bad_request(self):
+        response = self.client.patch('/hosts/bulk', {'names': ['host1.example.org'],
+                                                     'ttl': 100})
+        self.assertEqual(response.status_code, 400)
+
+
+class APIMxTestcase(APITransactionTestCase):
     """Test MX records."""
 
     def setUp(self):
@@ -988,6 +1197,8 @@ class APIForwardZonesTestCase(APITestCase):
         clean_and_save(self.ns_one)
         clean_and_save(self.ns_two)
         clean_and_save(self.zone_one)
+        # Zonefiles are published by zone name
+        cache.clear()
 
     def test_zones_get_404_not_found(self):
         """"Getting a non-existing entry should return 404"""
@@ -999,6 +1210,92 @@ class APIForwardZonesTestCase(APITestCase):
         response = self.client.get('/zones/%s' % self.zone_one.name)
         self.assertEqual(response.status_code, 200)
 
+    def _mark_zone_updated(self):
+        old = timezone.now() - timedelta(minutes=5)
+        ForwardZone.objects.filter(id=self.zone_one.id).update(updated=True,
+                                                               serialno_updated_at=old)
+
+    def test_zonefile_does_not_update_serialno(self):
+        """Getting the zonefile of an updated zone should not change it, the
+        serial number is updated by publish_zones"""
+        self._mark_zone_updated()
+        response = self.client.get('/zonefiles/%s' % self.zone_one.name)
+        self.assertEqual(response.status_code, 200)
+        zone = ForwardZone.objects.get(id=self.zone_one.id)
+        self.assertTrue(zone.updated)
+        self.assertEqual(zone.serialno, self.zone_one.serialno)
+        self.assertIn(str(zone.serialno), response.data)
+
+    def test_zonefile_published_without_database(self):
+        """A published zonefile should be served without reading the zone,
+        until the next publish_zones"""
+        publish_zones()
+        path = '/zonefiles/%s' % self.zone_one.name
+        etag = self.client.get(path)['ETag']
+        self._mark_zone_updated()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        self.assertEqual(response['ETag'], etag)
+        self.assertFalse([i for i in queries.captured_queries if 'zone' in i['sql']])
+        publish_zones()
+        response = self.client.get(path)
+        zone = ForwardZone.objects.get(id=self.zone_one.id)
+        self.assertGreater(zone.serialno, self.zone_one.serialno)
+        self.assertIn(str(zone.serialno), response.data)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_zonefile_artifact_published_without_database(self):
+        with tempfile.TemporaryDirectory() as artifact_dir, \
+                override_settings(ZONEFILE_ARTIFACT_DIR=artifact_dir):
+            publish_zones()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/zonefiles/%s' % self.zone_one.name)
+            self.assertTrue(response.streaming)
+            response.close()
+            self.assertFalse([i for i in queries.captured_queries if 'zone' in i['sql']])
+
+    def test_zonefile_deleted_zone_404_not_found(self):
+        """A published zonefile should be removed by publish_zones when the
+        zone has been deleted"""
+        publish_zones()
+        self.zone_one.delete()
+        publish_zones()
+        response = self.client.get('/zonefiles/%s' % self.zone_one.name)
+        self.assertEqual(response.status_code, 404)
+
+    def test_zonefile_artifact_deleted_zone_404_not_found(self):
+        with tempfile.TemporaryDirectory() as artifact_dir, \
+                override_settings(ZONEFILE_ARTIFACT_DIR=artifact_dir):
+            publish_zones()
+            self.zone_one.delete()
+            publish_zones()
+            response = self.client.get('/zonefiles/%s' % self.zone_one.name)
+            self.assertEqual(response.status_code, 404)
+
+    def test_zonefile_304_not_modified(self):
+        """Getting an unchanged zonefile with If-None-Match should return 304,
+        both from the cache and when published as a file"""
+        path = '/zonefiles/%s' % self.zone_one.name
+        response = self.client.get(path)
+        response = self.client.get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        with tempfile.TemporaryDirectory() as artifact_dir, \
+                override_settings(ZONEFILE_ARTIFACT_DIR=artifact_dir):
+            publish_zones()
+            response = self.client.get(path)
+            response.close()
+            etag = response['ETag']
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertFalse([i for i in queries.captured_queries if 'zone' in i['sql']])
+            self._mark_zone_updated()
+            publish_zones()
+            response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            response.close()
+            self.assertNotEqual(response['ETag'], etag)
+
     def test_zones_list_200_ok(self):
         """Listing all zones should return 200"""
         response = self.client.get('/zones/')
@@ -1164,6 +1461,51 @@ class APIZonesForwardDelegationTestCase(APITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data['results'], [])
 
+    def test_forward_replace_delegations_400_bad_request(self):
+        path = "/zones/example.org/delegations/"
+        bad = [{'name': 'delegated.example.com', 'nameservers': ['ns1.example.org']}]
+        response = self.client.put(path, bad, format='json')
+        self.assertEqual(response.status_code, 400)
+        bad = [{'name': 'delegated.example.org', 'nameservers': []}]
+        response = self.client.put(path, bad, format='json')
+        self.assertEqual(response.status_code, 400)
+        bad = [{'name': 'delegated.example.org', 'nameservers': ['ns1.example.org']},
+               {'name': 'delegated.example.org', 'nameservers': ['ns2.example.org']}]
+        response = self.client.put(path, bad, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class APIZonesDelegationReplaceTestCase(APITransactionTestCase):
+    """This class tests replacing all the delegations of a zone, which marks
+    the zone as updated when the transaction commits."""
+
+    def setUp(self):
+        self.client = get_token_client()
+        self.client.post("/zones/", {'name': 'example.org',
+                                     'primary_ns': ['ns1.example.org', 'ns2.example.org'],
+                                     'email': "hostmaster@example.org"})
+        self.client.post("/zones/example.org/delegations/",
+                         {'name': 'delegated.example.org',
+                          'nameservers': ['ns1.example.org', 'ns1.delegated.example.org']})
+        ForwardZone.objects.filter(name='example.org').update(updated=False)
+
+    def test_forward_replace_delegations_204_ok(self):
+        path = "/zones/example.org/delegations/"
+        data = [{'name': 'delegated2.example.org',
+                 'nameservers': ['ns1.example.org', 'ns2.delegated.example.org']},
+                {'name': 'delegated3.example.org',
+                 'nameservers': ['ns1.example.org']}]
+        response = self.client.put(path, data, format='json')
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get(path)
+        names = sorted(i['name'] for i in response.data['results'])
+        self.assertEqual(names, ['delegated2.example.org', 'delegated3.example.org'])
+        self.assertFalse(NameServer.objects.filter(name='ns1.delegated.example.org').exists())
+        response = self.client.get(f"{path}delegated2.example.org")
+        nameservers = sorted(i['name'] for i in response.json()['nameservers'])
+        self.assertEqual(nameservers, ['ns1.example.org', 'ns2.delegated.example.org'])
+        self.assertTrue(ForwardZone.objects.get(name='example.org').updated)
+
 
 class APIZonesReverseDelegationTestCase(APITestCase):
     """ This class defines test testsuite for api/zones/<name>/delegations/
@@ -1924,3 +2266,392 @@ class APIModelChangeLogsTestCase(APITestCase):
         response = self.client.get('/history/hosts/{}'.format(self.host_one.id))
         self.assertEqual(response.status_code, 200)
         self.assertIsInstance(response.data, list)
+
+
+class APIMetricsTestCase(APITestCase):
+    """This class tests the /metrics endpoint."""
+
+    def setUp(self):
+        self.client = get_token_client()
+
+    def test_metrics_200_ok(self):
+        self.client.get('/zones/')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertIn('mreg_requests_total{view="ZoneList",method="GET",status="200"}', content)
+        self.assertIn('mreg_db_queries_total{view="ZoneList"}', content)
+        self.assertIn('mreg_request_duration_seconds_count{view="ZoneList"}', content)
+
+    def test_metrics_streaming(self):
+        """Streaming responses are measured when their content is sent."""
+        host = Host.objects.create(name='dhcp.example.org', contact='mail@example.org')
+        Ipaddress.objects.create(host=host, ipaddress='10.0.0.10',
+                                 macaddress='aa:bb:cc:00:00:01')
+        labels = ('DhcpHostsAllV4',)
+        before = metrics.RESPONSE_BYTES.values[labels]
+        queries = metrics.DB_QUERIES.values[labels]
+        response = self.client.get('/dhcphosts/v4/all')
+        self.assertEqual(metrics.RESPONSE_BYTES.values[labels], before)
+        size = len(b''.join(response.streaming_content))
+        self.assertEqual(metrics.RESPONSE_BYTES.values[labels], before + size)
+        self.assertGreater(metrics.DB_QUERIES.values[labels], queries)
+
+    def test_metrics_403_forbidden(self):
+        response = self.client.get('/metrics', REMOTE_ADDR='192.0.2.1')
+        self.assertEqual(response.status_code, 403)
+
+
+class APIQueryCountTestCase(APITestCase):
+    """Check that the number of SQL queries for every URL in mreg.api.v1.urls
+    does not grow with the amount of data, by running the same requests
+    against a small and a large data set. Catches N+1 queries in the views,
+    serializers, signals and the zonefile generation."""
+
+    # The large size bulk deletes more than Django's delete chunk of 100
+    # rows of each model, so chunked deletes are caught too.
+    SIZES = ({'zones': 2, 'hosts': 20}, {'zones': 2, 'hosts': 300})
+
+    def setUp(self):
+        self.client = get_token_client()
+
+    def _make_data(self, zones, hosts):
+        generate(zones=zones, hosts=hosts)
+        zone = ForwardZone.objects.get(name=zone_name(0))
+        ForwardZoneDelegation.objects.bulk_create(
+            ForwardZoneDelegation(zone=zone, name=f'sub{i}.{zone.name}')
+            for i in range(hosts // 10))
+        ns = NameServer.objects.get(name=NAMESERVERS[0])
+        through = ForwardZoneDelegation.nameservers.through
+        through.objects.bulk_create(
+            through(forwardzonedelegation_id=i, nameserver_id=ns.id)
+            for i in ForwardZoneDelegation.objects.values_list('id', flat=True))
+        HinfoPreset.objects.bulk_create(HinfoPreset(cpu=f'cpu{i}', os='os')
+                                        for i in range(hosts // 10))
+        log_host_history(Host.objects.all(), 'saved')
+
+    def _get_requests(self):
+        """Return a dict of each URL pattern to a list of (method, path,
+        data) to request."""
+        zone = ForwardZone.objects.get(name=zone_name(0))
+        host = Host.objects.get(name=f'host0.{zone.name}')
+        network = ipv4_network(0)
+        net = f'{network.network_address}/{network.prefixlen}'
+        delegations = [{'name': name, 'nameservers': [NAMESERVERS[1]]} for name in
+                       zone.delegations.values_list('name', flat=True)]
+
+        def first(model):
+            return model.objects.order_by('id').values_list('id', flat=True).first()
+
+        ret = {
+            'cnames/': [('get', '/cnames/', None)],
+            'cnames/<name>': [('get', f'/cnames/alias0.{zone.name}', None)],
+            'dhcphosts/v4/all': [('get', '/dhcphosts/v4/all', None)],
+            'dhcphosts/v6/all': [('get', '/dhcphosts/v6/all', None)],
+            'dhcphosts/v6byv4/<ip>/<range>': [('get', '/dhcphosts/v6byv4/10.0.0.0/8', None)],
+            'dhcphosts/v6byv4/': [('get', '/dhcphosts/v6byv4/', None)],
+            'dhcphosts/changes': [('get', '/dhcphosts/changes?since=0', None)],
+            'dhcphosts/<ip>/<range>': [('get', '/dhcphosts/10.0.0.0/8', None)],
+            'hinfopresets/': [('get', '/hinfopresets/', None)],
+            'hinfopresets/<pk>': [('get', f'/hinfopresets/{first(HinfoPreset)}', None)],
+            'hosts/': [('get', '/hosts/', None),
+                       ('post', '/hosts/', {'name': f'new.{zone.name}',
+                                            'ipaddress': '10.255.0.1',
+                                            'contact': 'mail@example.org'})],
+            'hosts/bulk': [('patch', f'/hosts/bulk?name__endswith=.{zone.name}', {'ttl': 300})],
+            'hosts/bulk_delete': [('post', f'/hosts/bulk_delete?name__endswith=.{zone.name}', {})],
+            'hosts/<pk>': [('get', f'/hosts/{host.name}', None)],
+            'ipaddresses/': [('get', '/ipaddresses/', None)],
+            'ipaddresses/<pk>': [('get', f'/ipaddresses/{first(Ipaddress)}', None)],
+            'mxs/': [('get', '/mxs/', None)],
+            'mxs/<pk>': [('get', f'/mxs/{first(Mx)}', None)],
+            'naptrs/': [('get', '/naptrs/', None)],
+            'naptrs/<pk>': [('get', f'/naptrs/{first(Naptr)}', None)],
+            'nameservers/': [('get', '/nameservers/', None)],
+            'nameservers/<pk>': [('get', f'/nameservers/{first(NameServer)}', None)],
+            'ptroverrides/': [('get', '/ptroverrides/', None)],
+            'ptroverrides/<pk>': [('get', f'/ptroverrides/{first(PtrOverride)}', None)],
+            'srvs/': [('get', '/srvs/', None)],
+            'srvs/<pk>': [('get', f'/srvs/{first(Srv)}', None)],
+            'networks/': [('get', '/networks/', None)],
+            'networks/ip/<ip>': [('get', f'/networks/ip/{ipv4_address(0)}', None)],
+            'networks/<ip>/<range>': [('get', f'/networks/{net}', None)],
+            'txts/': [('get', '/txts/', None)],
+            'txts/<pk>': [('get', f'/txts/{first(Txt)}', None)],
+            'zones/': [('get', '/zones/', None)],
+            r'^zones/(?P<name>(\d+/)?[^/]+)$': [('get', f'/zones/{zone.name}', None)],
+            r'^zones/(?P<name>(\d+/)?[^/]+)/delegations/$': [
+                ('get', f'/zones/{zone.name}/delegations/', None),
+                ('put', f'/zones/{zone.name}/delegations/', delegations)],
+            r'^zones/(?P<name>(\d+/)?[^/]+)/delegations/(?P<delegation>(.*))': [
+                ('get', f'/zones/{zone.name}/delegations/sub0.{zone.name}', None)],
+            r'^zones/(?P<name>(\d+/)?[^/]+)/nameservers$': [
+                ('get', f'/zones/{zone.name}/nameservers', None)],
+            r'^zonefiles/(?P<name>(\d+/)?[^/]+)': [
+                ('get', f'/zonefiles/{name}', None) for name in (zone.name,) + REVERSE_ZONES],
+            'history/': [('get', '/history/', None)],
+            'history/<table>/<pk>': [('get', f'/history/host/{host.id}', None)],
+        }
+        for suffix in ('first_unused', 'ptroverride_list', 'ptroverride_host_list',
+                       'reserved_list', 'used_count', 'used_list', 'used_host_list',
+                       'unused_count', 'unused_list'):
+            ret[f'networks/<ip>/<range>/{suffix}'] = [('get', f'/networks/{net}/{suffix}', None)]
+        return ret
+
+    def _count_queries(self, requests):
+        """Return a dict of (pattern, number) to the number of queries used
+        by each request. Every request is run on the same data, as its
+        changes are rolled back, and with empty caches."""
+        ret = {}
+        for pattern, pattern_requests in requests.items():
+            for number, (method, path, data) in enumerate(pattern_requests):
+                cache.clear()
+                with transaction.atomic():
+                    with CaptureQueriesContext(connection) as queries:
+                        if data is None:
+                            response = getattr(self.client, method)(path)
+                        else:
+                            response = getattr(self.client, method)(path, data, format='json')
+                        if response.streaming:
+                            b''.join(response.streaming_content)
+                    transaction.set_rollback(True)
+                self.assertLess(response.status_code, 400, f'{method} {path}')
+                ret[(pattern, number)] = len(queries)
+        return ret
+
+    def test_query_count_independent_of_size(self):
+        counts = []
+        for size in self.SIZES:
+            with transaction.atomic():
+                self._make_data(**size)
+                requests = self._get_requests()
+                self.assertEqual(set(requests), {str(i.pattern) for i in urlpatterns},
+                                 'Every URL must have a request in _get_requests()')
+                counts.append(self._count_queries(requests))
+                transaction.set_rollback(True)
+        small, large = counts
+        changed = [f'{pattern} #{number}: {count} -> {large[(pattern, number)]} queries'
+                   for (pattern, number), count in small.items()
+                   if count != large[(pattern, number)]]
+        self.assertEqual(changed, [])
+
+
+class APIDhcpHostsTestCase(APITestCase):
+    """This class tests the DHCP host exports."""
+
+    def setUp(self):
+        self.client = get_token_client()
+        self.host = Host.objects.create(name='dhcp.example.org', contact='mail@example.org')
+        self.ipv4 = Ipaddress.objects.create(host=self.host, ipaddress='10.0.0.10',
+                                             macaddress='aa:bb:cc:00:00:01')
+        Ipaddress.objects.create(host=self.host, ipaddress='2001:db8::10',
+                                 macaddress='aa:bb:cc:00:00:01')
+        Ipaddress.objects.create(host=self.host, ipaddress='10.0.0.11')
+
+    def _get(self, path, **kwargs):
+        response = self.client.get(path, **kwargs)
+        if response.streaming:
+            response.data = b''.join(response.streaming_content).decode()
+        return response
+
+    def test_dhcphosts_json(self):
+        response = self._get('/dhcphosts/v4/all')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data),
+                         [{'host__name': 'dhcp.example.org', 'ipaddress': '10.0.0.10',
+                           'macaddress': 'aa:bb:cc:00:00:01'}])
+
+    def test_dhcphosts_isc(self):
+        response = self._get('/dhcphosts/v4/all?format=isc')
+        self.assertEqual(response.data,
+                         'host "dhcp.example.org_10.0.0.10" {\n'
+                         '    hardware ethernet aa:bb:cc:00:00:01;\n'
+                         '    fixed-address 10.0.0.10;\n'
+                         '    option host-name "dhcp.example.org";\n'
+                         '}\n')
+        response = self._get('/dhcphosts/v6/all?format=isc')
+        self.assertIn('fixed-address6 2001:db8::10;', response.data)
+
+    def test_dhcphosts_isc_error(self):
+        """Errors in the ISC format are comments, so that they cannot be
+        loaded as configuration."""
+        response = self._get('/dhcphosts/10.0.0.0/33?format=isc')
+        self.assertEqual(response.status_code, 400)
+        lines = response.content.decode().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertTrue(line.startswith('# '))
+
+    def test_dhcphosts_kea(self):
+        response = self._get('/dhcphosts/10.0.0.0/24?format=kea')
+        self.assertEqual(json.loads(response.data),
+                         {'reservations': [{'hostname': 'dhcp.example.org',
+                                            'hw-address': 'aa:bb:cc:00:00:01',
+                                            'ip-address': '10.0.0.10'}]})
+        response = self._get('/dhcphosts/v6/all?format=kea')
+        self.assertEqual(json.loads(response.data)['reservations'][0]['ip-addresses'],
+                         ['2001:db8::10'])
+
+    def test_dhcphosts_v6byv4(self):
+        host = Host.objects.create(name='dhcp2.example.org', contact='mail@example.org')
+        Ipaddress.objects.create(host=host, ipaddress='10.0.1.10',
+                                 macaddress='aa:bb:cc:00:00:02')
+        Ipaddress.objects.create(host=host, ipaddress='2001:db8::20')
+        expected = [{'host__name': 'dhcp2.example.org', 'ipaddress': '2001:db8::20',
+                     'macaddress': 'aa:bb:cc:00:00:02'}]
+        response = self._get('/dhcphosts/v6byv4/')
+        self.assertEqual(json.loads(response.data), expected)
+        response = self._get('/dhcphosts/v6byv4/10.0.1.0/24')
+        self.assertEqual(json.loads(response.data), expected)
+        response = self._get('/dhcphosts/v6byv4/10.0.0.0/24')
+        self.assertEqual(json.loads(response.data), [])
+        response = self._get('/dhcphosts/v6byv4/?format=isc')
+        self.assertIn('fixed-address6 2001:db8::20;', response.data)
+
+    def test_dhcphosts_changes(self):
+        def get_changes():
+            response = self.client.get('/dhcphosts/changes', {'since': seq})
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(response.data['more'])
+            return response.data['seq'], [(i['action'], i['hostname'], i['ipaddress'],
+                                           i['macaddress']) for i in response.data['changes']]
+
+        mac1, mac2 = 'aa:bb:cc:00:00:01', 'aa:bb:cc:00:00:02'
+        seq = 0
+        seq, changes = get_changes()
+        self.assertEqual(changes, [('saved', 'dhcp.example.org', '10.0.0.10', mac1),
+                                   ('saved', 'dhcp.example.org', '2001:db8::10', mac1)])
+        self.assertEqual(self._get('/dhcphosts/v4/all')['X-Dhcp-Change-Seq'], str(seq))
+        self.assertEqual(get_changes(), (seq, []))
+
+        self.ipv4.macaddress = mac2
+        self.ipv4.save()
+        seq, changes = get_changes()
+        self.assertEqual(changes, [('deleted', 'dhcp.example.org', '10.0.0.10', mac1),
+                                   ('saved', 'dhcp.example.org', '10.0.0.10', mac2)])
+
+        self.host.name = 'dhcp2.example.org'
+        self.host.save()
+        seq, changes = get_changes()
+        self.assertEqual(sorted(changes),
+                         [('deleted', 'dhcp.example.org', '10.0.0.10', mac2),
+                          ('deleted', 'dhcp.example.org', '2001:db8::10', mac1),
+                          ('saved', 'dhcp2.example.org', '10.0.0.10', mac2),
+                          ('saved', 'dhcp2.example.org', '2001:db8::10', mac1)])
+
+        self.ipv4.delete()
+        seq, changes = get_changes()
+        self.assertEqual(changes, [('deleted', 'dhcp2.example.org', '10.0.0.10', mac2)])
+
+        self.client.post('/hosts/bulk_delete', {'names': ['dhcp2.example.org']})
+        seq, changes = get_changes()
+        self.assertEqual(changes, [('deleted', 'dhcp2.example.org', '2001:db8::10', mac1)])
+
+    def test_dhcphosts_changes_limit(self):
+        with override_settings(DHCP_CHANGES_LIMIT=1):
+            response = self.client.get('/dhcphosts/changes', {'since': 0})
+            self.assertTrue(response.data['more'])
+            self.assertEqual(len(response.data['changes']), 1)
+            response = self.client.get('/dhcphosts/changes', {'since': response.data['seq']})
+            self.assertFalse(response.data['more'])
+            self.assertEqual(len(response.data['changes']), 1)
+        response = self.client.get('/dhcphosts/changes')
+        self.assertEqual(response.status_code, 400)
+
+    def test_dhcphosts_changes_pruned(self):
+        """Reading from before the pruned changes should require a full
+        reload"""
+        seq = self.client.get('/dhcphosts/changes', {'since': 0}).data['seq']
+        self.ipv4.macaddress = 'aa:bb:cc:00:00:02'
+        self.ipv4.save()
+        DhcpChange.objects.filter(seq__lte=seq).update(timestamp=timezone.now() - timedelta(days=60))
+        self.assertEqual(DhcpChange.prune(timezone.now() - timedelta(days=30)), seq)
+        response = self.client.get('/dhcphosts/changes', {'since': 0})
+        self.assertEqual(response.status_code, 410)
+        response = self.client.get('/dhcphosts/changes', {'since': seq})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['changes']), 2)
+        DhcpChange.prune(timezone.now())
+        response = self.client.get('/dhcphosts/changes', {'since': seq})
+        self.assertEqual(response.status_code, 410)
+        response = self.client.get('/dhcphosts/changes', {'since': seq + 2})
+        self.assertEqual(response.status_code, 200)
+
+    def test_dhcphosts_etag(self):
+        etag = self._get('/dhcphosts/v4/all')['ETag']
+        response = self._get('/dhcphosts/v4/all', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # Not exported
+        Ipaddress.objects.create(host=self.host, ipaddress='10.0.0.12')
+        self.assertEqual(self._get('/dhcphosts/v4/all')['ETag'], etag)
+        # Other formats have their own ETag
+        self.assertNotEqual(self._get('/dhcphosts/v4/all?format=isc')['ETag'], etag)
+
+        def assert_changed():
+            nonlocal etag
+            response = self._get('/dhcphosts/v4/all', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+            etag = response['ETag']
+
+        self.ipv4.macaddress = 'aa:bb:cc:00:00:02'
+        self.ipv4.save()
+        assert_changed()
+        self.ipv4.macaddress = ''
+        self.ipv4.save()
+        assert_changed()
+        self.ipv4.macaddress = 'aa:bb:cc:00:00:01'
+        self.ipv4.save()
+        assert_changed()
+        self.host.name = 'dhcp2.example.org'
+        self.host.save()
+        assert_changed()
+        self.client.post('/hosts/bulk_delete', {'names': ['dhcp2.example.org']})
+        assert_changed()
+
+
+class APIProfilingTestCase(APITestCase):
+    """This class tests the profiling of requests."""
+
+    def setUp(self):
+        self.client = get_token_client()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def _get_profiles(self):
+        ret = []
+        for root, dirs, files in os.walk(self.tmpdir.name):
+            ret.extend(os.path.join(root, name) for name in files)
+        return sorted(ret)
+
+    def test_sampled_request_is_saved(self):
+        with override_settings(PROFILE_DIR=self.tmpdir.name, PROFILE_SAMPLE_RATE=1.0):
+            self.client.get('/zones/')
+        profile, sql = self._get_profiles()
+        self.assertEqual(os.path.basename(os.path.dirname(profile)), 'ZoneList')
+        self.assertTrue(profile.endswith('.prof'))
+        with open(sql) as f:
+            info = json.load(f)
+        self.assertEqual(info['path'], '/zones/')
+        self.assertEqual(info['status'], 200)
+        self.assertTrue(info['queries'])
+
+    def test_slow_threshold(self):
+        with override_settings(PROFILE_DIR=self.tmpdir.name, PROFILE_SLOW_THRESHOLD=3600):
+            self.client.get('/zones/')
+        self.assertEqual(self._get_profiles(), [])
+        with override_settings(PROFILE_DIR=self.tmpdir.name, PROFILE_SLOW_THRESHOLD=0):
+            self.client.get('/zones/')
+        self.assertEqual(len(self._get_profiles()), 2)
+
+    def test_header_requires_staff(self):
+        with override_settings(PROFILE_DIR=self.tmpdir.name):
+            with mock.patch('cProfile.Profile') as profile:
+                self.client.get('/zones/', HTTP_X_MREG_PROFILE='1')
+                APIClient().get('/zones/', HTTP_X_MREG_PROFILE='1')
+                profile.assert_not_called()
+            self.assertEqual(self._get_profiles(), [])
+            User.objects.filter(username='nobody').update(is_staff=True)
+            cache.clear()
+            self.client.get('/zones/', HTTP_X_MREG_PROFILE='1')
+            self.assertEqual(len(self._get_profiles()), 2)
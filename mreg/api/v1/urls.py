@@ -9,10 +9,13 @@ urlpatterns = [
     path('dhcphosts/v6/all', views.DhcpHostsAllV6.as_view()),
     path('dhcphosts/v6byv4/<ip>/<range>', views.DhcpHostsV4ByV6.as_view()),
     path('dhcphosts/v6byv4/', views.DhcpHostsV4ByV6.as_view()),
+    path('dhcphosts/changes', views.DhcpHostsChanges.as_view()),
     path('dhcphosts/<ip>/<range>', views.DhcpHostsByRange.as_view()),
     path('hinfopresets/', views.HinfoPresetList.as_view()),
     path('hinfopresets/<pk>', views.HinfoPresetDetail.as_view()),
     path('hosts/', views.HostList.as_view()),
+    path('hosts/bulk', views.HostBulkUpdate.as_view()),
+    path('hosts/bulk_delete', views.HostBulkDelete.as_view()),
     path('hosts/<pk>', views.HostDetail.as_view()),
     path('ipaddresses/', views.IpaddressList.as_view()),
     path('ipaddresses/<pk>', views.IpaddressDetail.as_view()),
@@ -6,34 +6,44 @@ from collections import defaultdict
 
 import django.core.exceptions
 
+from django.conf import settings
 from django.db import transaction
-from django.http import Http404
+from django.db.models import OuterRef, Subquery
+from django.http import (FileResponse, Http404, HttpResponseNotModified,
+        StreamingHttpResponse)
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
+from django.utils.http import parse_etags
 from rest_framework import (filters, generics, renderers, status)
 from rest_framework.authentication import TokenAuthentication
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import api_view
-from rest_framework.exceptions import ParseError, MethodNotAllowed
-from rest_framework.renderers import JSONRenderer
+from rest_framework.exceptions import ParseError, MethodNotAllowed, PermissionDenied
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework_extensions.etag.mixins import ETAGMixin
+from url_filter.constants import StrictMode
 from url_filter.filtersets import ModelFilterSet
 
+from mreg.api.v1.dhcp import DHCP_RENDERERS
 from mreg.api.v1.serializers import (CnameSerializer, HinfoPresetSerializer,
         HostNameSerializer, HostSerializer, HostSaveSerializer,
         IpaddressSerializer, MxSerializer, NameServerSerializer,
         NaptrSerializer, PtrOverrideSerializer, SrvSerializer,
         NetworkSerializer, TxtSerializer, ForwardZoneSerializer,
         ForwardZoneDelegationSerializer, ReverseZoneSerializer,
-        ReverseZoneDelegationSerializer, ModelChangeLogSerializer)
-from mreg.models import (Cname, ForwardZone, ForwardZoneDelegation, HinfoPreset, Host, Ipaddress,
-                         Mx, NameServer, Naptr, Network, PtrOverride, ReverseZone,
+        ReverseZoneDelegationSerializer, ModelChangeLogSerializer,
+        prefetch_host_data)
+from mreg.models import (Cname, DhcpChange, ForwardZone,
+                         ForwardZoneDelegation, HinfoPreset, Host, Ipaddress, Mx,
+                         NameServer, Naptr, Network, PtrOverride, ReverseZone,
                          ReverseZoneDelegation, Srv, Txt, ModelChangeLog)
+from mreg.batch import (add_updated_zones, bulk_operation, delete_hosts,
+        get_zone_ids_for_hosts, mark_zones_updated, update_ptr_overrides)
+from mreg.history import get_history, log_host_history
+from mreg.publish import get_published, get_zonefile_entry
 from mreg.utils import create_serialno
 
-from .zonefile import ZoneFile
 
 
 # These filtersets are used for applying generic filtering to all objects.
@@ -212,7 +222,7 @@ class HostList(generics.ListCreateAPIView):
     ordering_fields = '__all__'
 
     def get_queryset(self):
-        qs = super().get_queryset()
+        qs = prefetch_host_data(super().get_queryset())
         return HostFilterSet(data=self.request.GET, queryset=qs).filter()
 
     def post(self, request, *args, **kwargs):
@@ -282,6 +292,117 @@ class HostDetail(MregRetrieveUpdateDestroyAPIView):
             return Response(status=status.HTTP_204_NO_CONTENT, headers={'Location': location})
 
 
+def _get_list(data, key):
+    """Return the list for key from either form or json data."""
+    if hasattr(data, 'getlist'):
+        return data.getlist(key)
+    value = data.get(key, [])
+    if isinstance(value, str):
+        return [value]
+    return value
+
+
+def _get_bulk_hosts(request):
+    """
+    Return the hosts selected for a bulk operation, either by a list of names
+    in the request body, or by filters in the query string. Every query
+    parameter must be a valid filter, so that a misspelled one can not select
+    all the hosts.
+    """
+    names = _get_list(request.data, 'names')
+    params = request.query_params
+    if not names and not params:
+        raise ParseError(detail="No host names or filters given")
+    qs = Host.objects.all()
+    if params:
+        filterset = HostFilterSet(data=params, queryset=qs, strict_mode=StrictMode.fail)
+        try:
+            specs = filterset.get_specs()
+        except django.core.exceptions.ValidationError as error:
+            raise ParseError(detail=error.message_dict)
+        # Unknown filters are skipped, even in strict mode
+        values = [value for key, values in params.lists() for value in values]
+        if len(specs) != len(values):
+            raise ParseError(detail="Unknown filters in: {}".format(", ".join(sorted(params))))
+        if not all(values):
+            raise ParseError(detail="Empty filter values are not allowed")
+        qs = filterset.filter()
+    if names:
+        qs = qs.filter(name__in=names)
+        missing = set(names) - set(qs.values_list('name', flat=True))
+        if missing:
+            raise Http404("Unknown hosts: {}".format(", ".join(sorted(missing))))
+    return qs
+
+
+class HostBulkDelete(generics.GenericAPIView):
+    """
+    post:
+    Delete multiple hosts, given by a list of names in "names" or by
+    filters in the query string. Refused if any of the hosts are in use as
+    nameservers.
+    """
+    queryset = Host.objects.all()
+    serializer_class = HostNameSerializer
+
+    def post(self, request, *args, **kwargs):
+        hosts = _get_bulk_hosts(request)
+        with transaction.atomic(), bulk_operation():
+            # Lock the hosts, and their nameservers so that they can not be
+            # added to a zone, until the hosts are deleted.
+            hosts = Host.objects.filter(id__in=hosts.values('id')).select_for_update()
+            host_ids = list(hosts.values_list('id', flat=True))
+            hosts = Host.objects.filter(id__in=host_ids)
+            names = list(hosts.values_list('name', flat=True))
+            list(NameServer.objects.select_for_update().filter(name__in=names))
+            nameservers = NameServer.get_in_use(names).values_list('name', flat=True)
+            if nameservers:
+                raise PermissionDenied(detail='Hosts are nameservers and cannot be deleted until '
+                                              'removed from all zones they are setup as a '
+                                              'nameserver: {}'.format(", ".join(nameservers)))
+            forward_ids, reverse_ids = get_zone_ids_for_hosts(host_ids)
+            log_host_history(hosts, 'deleted')
+            # A PtrOverride is removed when its IP address is deleted, even if
+            # the override belongs to another host.
+            ips = Ipaddress.objects.filter(host__in=host_ids)
+            dhcp = ips.exclude(macaddress='').values_list('host__name', 'ipaddress', 'macaddress')
+            dhcp = [('deleted',) + i for i in dhcp]
+            update_ptr_overrides(removed=ips.values_list('ipaddress', flat=True))
+            delete_hosts(host_ids)
+            mark_zones_updated(forward_ids, reverse_ids)
+            DhcpChange.log(dhcp)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class HostBulkUpdate(generics.GenericAPIView):
+    """
+    patch:
+    Update the same fields on multiple hosts, given by a list of names in
+    "names" or by filters in the query string. Renaming is not allowed.
+    """
+    queryset = Host.objects.all()
+    serializer_class = HostSaveSerializer
+
+    def patch(self, request, *args, **kwargs):
+        if "name" in request.data:
+            content = {'ERROR': 'Not allowed to change name'}
+            return Response(content, status=status.HTTP_403_FORBIDDEN)
+
+        hosts = _get_bulk_hosts(request)
+        data = {key: value for key, value in request.data.items() if key != 'names'}
+        serializer = HostSaveSerializer(data=data, partial=True)
+        serializer.is_valid(raise_exception=True)
+
+        with transaction.atomic(), bulk_operation():
+            hosts = Host.objects.filter(id__in=hosts.values('id')).select_for_update()
+            host_ids = list(hosts.values_list('id', flat=True))
+            hosts = Host.objects.filter(id__in=host_ids)
+            hosts.update(**serializer.validated_data)
+            mark_zones_updated(*get_zone_ids_for_hosts(host_ids))
+            log_host_history(hosts, 'saved')
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
 class IpaddressList(generics.ListCreateAPIView):
     """
     get:
@@ -751,12 +872,12 @@ class ZoneList(generics.ListCreateAPIView):
     serializer_class = ForwardZoneSerializer
 
     def _get_forward(self):
-        self.queryset = ForwardZone.objects.all().order_by('id')
+        self.queryset = ForwardZone.objects.all().order_by('id').prefetch_related('nameservers')
         qs = super(ZoneList, self).get_queryset()
         return ForwardZoneFilterSet(data=self.request.GET, queryset=qs).filter()
 
     def _get_reverse(self):
-        self.queryset = ReverseZone.objects.all().order_by('id')
+        self.queryset = ReverseZone.objects.all().order_by('id').prefetch_related('nameservers')
         qs = super(ZoneList, self).get_queryset()
         self.serializer_class = ReverseZoneSerializer
         return ReverseZoneFilterSet(data=self.request.GET, queryset=qs).filter()
@@ -808,6 +929,11 @@ class ZoneDelegationList(generics.ListCreateAPIView):
 
     post:
     Create a delegation for the zone.
+
+    put:
+    Replace all the zone's delegations. Takes a list of objects with the
+    name and nameservers of each delegation. Delegations not in the list are
+    deleted.
     """
 
     lookup_field = 'name'
@@ -822,13 +948,13 @@ class ZoneDelegationList(generics.ListCreateAPIView):
         zonename = self.kwargs[self.lookup_field]
         if zonename.endswith(".arpa"):
             self.parentzone = get_object_or_404(ReverseZone, name=zonename)
-            self.queryset = self.parentzone.delegations.all().order_by('id')
+            self.queryset = self.parentzone.delegations.order_by('id').prefetch_related('nameservers')
             self.serializer_class = ReverseZoneDelegationSerializer
             qs = super().get_queryset()
             return ReverseZoneFilterSet(data=self.request.query_params, queryset=qs).filter()
         else:
             self.parentzone = get_object_or_404(ForwardZone, name=zonename)
-            self.queryset = self.parentzone.delegations.all().order_by('id')
+            self.queryset = self.parentzone.delegations.order_by('id').prefetch_related('nameservers')
             qs = super().get_queryset()
             return ForwardZoneFilterSet(data=self.request.query_params, queryset=qs).filter()
 
@@ -852,6 +978,87 @@ class ZoneDelegationList(generics.ListCreateAPIView):
         location = f"/zones/{self.parentzone.name}/delegations/{delegation.name}"
         return Response(status=status.HTTP_201_CREATED, headers={'Location': location})
 
+    def put(self, request, *args, **kwargs):
+        self.get_queryset()
+        model = self.get_serializer_class().Meta.model
+        zone = self.parentzone
+        wanted = _get_delegation_set(request.data, model, zone)
+
+        with transaction.atomic():
+            # Lock the zone, so that concurrent replacements of its
+            # delegations are done one after the other.
+            type(zone).objects.select_for_update().get(id=zone.id)
+            existing = {i.name: i for i in zone.delegations.all()}
+            conflicts = model.objects.filter(name__in=wanted).exclude(zone=zone)
+            conflicts = conflicts.values_list('name', flat=True)
+            if conflicts:
+                content = {'ERROR': 'Zone name already in use: {}'.format(", ".join(conflicts))}
+                return Response(content, status=status.HTTP_409_CONFLICT)
+
+            through = model.nameservers.through
+            fk = f'{model._meta.model_name}_id'
+            current = defaultdict(set)
+            links = through.objects.filter(**{f'{fk}__in': [i.id for i in existing.values()]})
+            for delegation_id, name in links.values_list(fk, 'nameserver__name'):
+                current[delegation_id].add(name)
+
+            removed = [i for name, i in existing.items() if name not in wanted]
+            changed = [i for name, i in existing.items()
+                       if name in wanted and current[i.id] != wanted[name]]
+            added = model.objects.bulk_create(
+                model(zone=zone, name=name) for name in sorted(wanted)
+                if name not in existing)
+
+            nameservers = {i.name: i for i in
+                           NameServer.objects.filter(name__in=set().union(*wanted.values()))}
+            missing = set().union(*wanted.values()) - set(nameservers)
+            for ns in NameServer.objects.bulk_create(
+                    NameServer(name=name) for name in sorted(missing)):
+                nameservers[ns.name] = ns
+
+            model.objects.filter(id__in=[i.id for i in removed]).delete()
+            through.objects.filter(**{f'{fk}__in': [i.id for i in changed]}).delete()
+            through.objects.bulk_create(
+                through(**{fk: i.id, 'nameserver_id': nameservers[name].id})
+                for i in changed + added for name in sorted(wanted[i.name]))
+
+            old_ns = set().union(*(current[i.id] for i in removed + changed))
+            if old_ns:
+                NameServer.with_usedcount().filter(name__in=old_ns, usedcount=0).delete()
+
+            if isinstance(zone, ReverseZone):
+                add_updated_zones(reverse_ids=[zone.id])
+            else:
+                add_updated_zones(forward_ids=[zone.id])
+        location = f"/zones/{zone.name}/delegations/"
+        return Response(status=status.HTTP_204_NO_CONTENT, headers={'Location': location})
+
+
+def _get_delegation_set(data, model, zone):
+    """Validate a list of delegations given to ZoneDelegationList.put, and
+    return it as a dict of delegation name to a set of nameserver names."""
+    if not isinstance(data, list):
+        raise ParseError(detail="Expected a list of delegations")
+    ret = dict()
+    for delegation in data:
+        if not isinstance(delegation, dict) or not isinstance(delegation.get('name'), str):
+            raise ParseError(detail="Each delegation must be an object with a name")
+        name = delegation['name']
+        if name in ret:
+            raise ParseError(detail=f"Delegation {name} is used multiple times")
+        try:
+            model._meta.get_field('name').run_validators(name)
+        except django.core.exceptions.ValidationError as error:
+            raise ParseError(detail=str(error))
+        if not name.endswith(f".{zone.name}"):
+            raise ParseError(detail=f"Delegation {name} is not contained in {zone.name}")
+        nameservers = delegation.get('nameservers')
+        if not isinstance(nameservers, list):
+            raise ParseError(detail=f"Nameservers for {name} must be a list")
+        _validate_nameservers(nameservers)
+        ret[name] = set(nameservers)
+    return ret
+
 
 class ZoneDetail(MregRetrieveUpdateDestroyAPIView):
     """
@@ -1009,7 +1216,7 @@ class ModelChangeLogList(generics.ListAPIView):
 
     def get(self, request, *args, **kwargs):
         # Return a list of available tables there are logged histories for.
-        tables = list(set([value['table_name'] for value in self.queryset.values('table_name')]))
+        tables = list(self.queryset.order_by().values_list('table_name', flat=True).distinct())
         return Response(data=tables, status=status.HTTP_200_OK)
 
 
@@ -1028,9 +1235,7 @@ class ModelChangeLogDetail(generics.RetrieveAPIView):
         query_table = self.kwargs['table']
         query_row = self.kwargs['pk']
         try:
-            logs_by_date = [vals for vals in self.queryset.filter(table_name=query_table,
-                                                                  table_row=query_row).order_by('timestamp').values()]
-
+            logs_by_date = get_history(query_table, query_row)
             return Response(logs_by_date, status=status.HTTP_200_OK)
         except ModelChangeLog.DoesNotExist:
             raise Http404
@@ -1043,62 +1248,133 @@ def _get_ips_by_range(iprange):
     return Ipaddress.objects.filter(ipaddress__range=(from_ip, to_ip))
 
 
-def _dhcphosts_by_range(iprange):
-    ips = _get_ips_by_range(iprange)
-    ips = ips.exclude(macaddress='').order_by('ipaddress')
-    ips = ips.values('host__name', 'ipaddress', 'macaddress')
-    return Response(ips)
+def _stream_dhcphosts(request, rows):
+    """Return a response streaming the rows of (host name, IP address, MAC
+    address) in the format chosen by the request, see mreg.api.v1.dhcp."""
+    renderer = request.accepted_renderer
+    content = (i.encode('utf-8') for i in renderer.render_rows(rows))
+    return StreamingHttpResponse(content, content_type=f'{renderer.media_type}; charset=utf-8')
+
+
+def _dhcphosts_by_range(request, iprange):
+    # The changes are numbered before the data is read, so that a change made
+    # in between gives a newer ETag on the next request, and is in the change
+    # feed after the X-Dhcp-Change-Seq.
+    seq = DhcpChange.number_changes()
+    etag = '"{}-{}"'.format(seq, request.accepted_renderer.format)
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        ips = _get_ips_by_range(iprange)
+        ips = ips.exclude(macaddress='').order_by('ipaddress')
+        ips = ips.values_list('host__name', 'ipaddress', 'macaddress')
+        response = _stream_dhcphosts(request, ips.iterator())
+    response['ETag'] = etag
+    response['X-Dhcp-Change-Seq'] = seq
+    return response
+
 
 class DhcpHostsAllV4(generics.GenericAPIView):
+    """
+    get:
+    Returns the IPv4 addresses with a MAC address. Use ?format=isc or
+    ?format=kea for ISC dhcpd or Kea configuration. The ETag changes when
+    any reservation changes, also outside the exported range. The
+    X-Dhcp-Change-Seq header is the sequence to get later changes from
+    /dhcphosts/changes.
+    """
+    renderer_classes = DHCP_RENDERERS
 
     def get(self, request, *args, **kwargs):
-        return _dhcphosts_by_range('0.0.0.0/0')
+        return _dhcphosts_by_range(request, '0.0.0.0/0')
 
 
 class DhcpHostsAllV6(generics.GenericAPIView):
+    """
+    get:
+    Returns the IPv6 addresses with a MAC address, as DhcpHostsAllV4.
+    """
+    renderer_classes = DHCP_RENDERERS
 
     def get(self, request, *args, **kwargs):
-        return _dhcphosts_by_range('::/0')
+        return _dhcphosts_by_range(request, '::/0')
 
 
 class DhcpHostsByRange(generics.GenericAPIView):
+    """
+    get:
+    Returns the addresses in the range with a MAC address, as DhcpHostsAllV4.
+    """
+    renderer_classes = DHCP_RENDERERS
 
     def get(self, request, *args, **kwargs):
-        return _dhcphosts_by_range(_get_iprange(kwargs))
+        return _dhcphosts_by_range(request, _get_iprange(kwargs))
 
 
-def _dhcpv6_hosts_by_ipv4(iprange):
+class DhcpHostsChanges(generics.GenericAPIView):
+    """
+    get:
+    Returns the reservations saved or deleted after the sequence given by
+    ?since=, oldest first, with at most DHCP_CHANGES_LIMIT changes. A
+    changed reservation is returned as the old one deleted and the new one
+    saved. "seq" is the sequence to use as "since" in the next request, and
+    "more" tells if there are more changes. Returns 410 Gone if changes
+    after since have been pruned, and the full export must be reloaded.
+    """
+
+    def get(self, request, *args, **kwargs):
+        try:
+            since = int(request.query_params['since'])
+        except (KeyError, ValueError):
+            raise ParseError(detail="since must be given as an integer")
+        DhcpChange.number_changes()
+        if since + 1 < DhcpChange.get_oldest_seq():
+            content = {'ERROR': 'Changes after {} have been pruned, reload the full '
+                                'export'.format(since)}
+            return Response(content, status=status.HTTP_410_GONE)
+        limit = getattr(settings, 'DHCP_CHANGES_LIMIT', 10000)
+        changes = DhcpChange.objects.filter(seq__gt=since).order_by('seq')
+        changes = list(changes.values('seq', 'action', 'hostname', 'ipaddress',
+                                      'macaddress')[:limit + 1])
+        more = len(changes) > limit
+        changes = changes[:limit]
+        seq = changes[-1]['seq'] if changes else since
+        return Response({'seq': seq, 'more': more, 'changes': changes})
+
+
+def _dhcpv6_hosts_by_ipv4(request, iprange):
     """
     Find all hosts which have both an ipv4 and ipv6 address,
     and where the ipv4 address has a mac assosicated.
     Future fun: limit to hosts which have only one ipv4 and ipv6 address?
+
+    Done in a single query, with the mac of each host's ipv4 address in a
+    subquery, and streamed.
     """
-    ipv4 = _get_ips_by_range(iprange)
-    ipv4 = ipv4.exclude(macaddress='')
-    ipv4 = ipv4.select_related('host')
-    ipv4_host_ids = [ip.host.id for ip in ipv4]
-    ipv4_host2mac = dict([(hostname, mac) for hostname, mac in
-                          ipv4.values_list('host__name', 'macaddress')])
-    ipv6 = _get_ips_by_range('::/0')
-    ipv6 = ipv6.filter(macaddress='')
-    ipv6 = ipv6.filter(host__in=ipv4_host_ids).order_by('ipaddress')
-    ret = []
-    for hostname, ip in ipv6.values_list('host__name', 'ipaddress'):
-        ret.append({'host__name': hostname, 'ipaddress': ip,
-                    'macaddress': ipv4_host2mac[hostname]})
-    return Response(ret)
+    ipv4 = _get_ips_by_range(iprange).filter(host=OuterRef('host'))
+    ipv4 = ipv4.exclude(macaddress='').order_by('ipaddress').values('macaddress')
+    ipv6 = _get_ips_by_range('::/0').filter(macaddress='')
+    ipv6 = ipv6.annotate(ipv4_mac=Subquery(ipv4[:1])).filter(ipv4_mac__isnull=False)
+    ipv6 = ipv6.order_by('ipaddress').values_list('host__name', 'ipaddress', 'ipv4_mac')
+    return _stream_dhcphosts(request, ipv6.iterator())
 
 
 class DhcpHostsV4ByV6(APIView):
+    """
+    get:
+    Returns the IPv6 addresses without a MAC address, of the hosts with a
+    MAC address on an IPv4 address in the range, with that MAC address.
+    Takes the same formats as DhcpHostsAllV4, but has no ETag.
+    """
 
-    renderer_classes = (JSONRenderer, )
+    renderer_classes = DHCP_RENDERERS
 
     def get(self, request, *args, **kwargs):
         if 'ip' in kwargs:
             iprange = _get_iprange(kwargs)
         else:
             iprange = '0.0.0.0/0'
-        return _dhcpv6_hosts_by_ipv4(iprange)
+        return _dhcpv6_hosts_by_ipv4(request, iprange)
 
 
 class PlainTextRenderer(renderers.BaseRenderer):
@@ -1118,7 +1394,8 @@ class ZoneFileDetail(generics.GenericAPIView):
     All models should have a zf_string method that outputs its relevant data.
 
     get:
-    Generate zonefile for a given zone.
+    Get the latest published zonefile for a given zone. Answers 304 if
+    If-None-Match has the ETag of the zonefile.
     """
     renderer_classes = (PlainTextRenderer, )
     lookup_field = 'name'
@@ -1133,8 +1410,29 @@ class ZoneFileDetail(generics.GenericAPIView):
         return super().get_queryset()
 
     def get(self, request, *args, **kwargs):
-        zone = get_object_or_404(self.get_queryset(), name=self.kwargs[self.lookup_field])
-        # XXX: a force argument to force serialno update?
-        zone.update_serialno()
-        zonefile = ZoneFile(zone)
-        return Response(zonefile.generate())
+        # The published zonefile is served without using the database, and
+        # serial numbers are only updated by the publish_zones command.
+        name = self.kwargs[self.lookup_field]
+        published = get_published(name)
+        zonefile = None
+        if published is not None and 'path' in published:
+            try:
+                zonefile = open(published['path'], 'rb')
+            except OSError:
+                # Removed by newer versions since the current one was read
+                published = None
+        if published is None:
+            zone = get_object_or_404(self.get_queryset(), name=name)
+            published = get_zonefile_entry(zone)
+        etag = '"{}"'.format(published['sha256'])
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            if zonefile is not None:
+                zonefile.close()
+            response = HttpResponseNotModified()
+        elif zonefile is not None:
+            # Served with the server's file wrapper, e.g. sendfile.
+            response = FileResponse(zonefile, content_type='text/plain; charset=utf-8')
+        else:
+            response = Response(published['data'])
+        response['ETag'] = etag
+        return response
@@ -5,6 +5,14 @@ from collections import defaultdict
 from mreg.models import Cname, ForwardZone, Host, Ipaddress, Mx, Naptr, Srv, Txt
 from mreg.utils import clear_none, idna_encode, qualify
 
+# Record formats. Bound format methods with positional fields, so a record
+# is formatted without building a dict and parsing the template each time.
+RECORD_FORMAT = '{:24} {:5} IN {:6} {:39}\n'.format
+MX_FORMAT = '{:24} {:5} IN {} {:6} {:39}\n'.format
+NAPTR_FORMAT = '{:24} {:5} IN {:6} {} {} "{}" "{}" "{}" {}\n'.format
+PTR_FORMAT = '{} {}\tPTR\t{}.\n'.format
+ORIGIN_FORMAT = '$ORIGIN {}.\n'.format
+
 
 class ZoneFile:
     def __init__(self, zone):
@@ -23,6 +31,16 @@ class Common:
     def __init__(self, zone):
         self.zone = zone
         self.glue_done = set()
+        self._names = dict()
+
+    def name(self, name):
+        """Return the name qualified for the zone and IDNA encoded. Names are
+        often repeated, e.g. MX targets, so the result is kept."""
+        try:
+            return self._names[name]
+        except KeyError:
+            ret = self._names[name] = idna_encode(qualify(name, self.zone.name))
+            return ret
 
     def get_glue(self, ns):
         """Returns glue for a nameserver. If already used return blank"""
@@ -44,23 +62,26 @@ class Common:
         # in the zonefile.
         if host.zone == self.zone:
             return ""
-        data = ""
-        for ip in host.ipaddresses.all():
-            data += ip.zf_string(self.zone.name)
-        return data
+        name = self.name(ns)
+        ttl = clear_none(host.ttl)
+        data = []
+        for ip in host.ipaddresses.values_list('ipaddress', flat=True):
+            ip = ipaddress.ip_address(ip)
+            data.append(RECORD_FORMAT(name, ttl, 'A' if ip.version == 4 else 'AAAA', str(ip)))
+        return "".join(data)
 
     def get_ns_data(self, qs):
-        data = ""
+        data = []
         qs = qs.prefetch_related("nameservers")
         for sub in qs:
             nameservers = sub.nameservers.all()
-            if not nameservers.exists():
+            if not nameservers:
                 # XXX What to do?
                 return f"OPS: NO NS FOR {sub.name}\n"
             for ns in nameservers:
-                data += ns.zf_string(self.zone.name, subzone=sub.name)
-                data += self.get_glue(ns.name)
-        return data
+                data.append(ns.zf_string(self.zone.name, subzone=sub.name))
+                data.append(self.get_glue(ns.name))
+        return "".join(data)
 
     def get_delegations(self):
         data = ""
@@ -70,6 +91,14 @@ class Common:
             data = ';\n; Delegations\n;\n' + data
         return data
 
+    def get_header(self):
+        zone = self.zone
+        data = [zone.zf_string, ';\n; Name servers\n;\n']
+        for ns in zone.nameservers.all():
+            data.append(ns.zf_string(zone.name))
+        data.append(self.get_delegations())
+        return "".join(data)
+
 
 class ForwardFile(Common):
 
@@ -78,71 +107,29 @@ class ForwardFile(Common):
             iptype = "A"
         else:
             iptype = "AAAA"
-
-        data = {
-            'name': name,
-            'ttl': ttl,
-            'record_type': iptype,
-            'record_data': str(ip),
-        }
-        return '{name:24} {ttl:5} IN {record_type:6} {record_data:39}\n'.format_map(data)
+        return RECORD_FORMAT(name, ttl, iptype, str(ip))
 
     def mx_zf_string(self, name, ttl, priority, mx):
-
-        data = {
-            'name': name,
-            'ttl': ttl,
-            'record_type': "MX",
-            'priority': priority,
-            'mx': idna_encode(qualify(mx, self.zone.name))
-        }
-        return '{name:24} {ttl:5} IN {record_type} {priority:6} {mx:39}\n'.format_map(data)
+        return MX_FORMAT(name, ttl, "MX", priority, self.name(mx))
 
     def txt_zf_string(self, name, ttl, txt):
-
-        data = {
-            'name': name,
-            'ttl': ttl,
-            'record_type': "TXT",
-            'record_data': f'"{txt}"'
-        }
-        return '{name:24} {ttl:5} IN {record_type:6} {record_data:39}\n'.format_map(data)
+        return RECORD_FORMAT(name, ttl, "TXT", f'"{txt}"')
 
     def naptr_zf_string(self, name, ttl, preference, order, flag, service, regex, replacement):
         """String representation for zonefile export."""
         if flag in ('a', 's'):
-            replacement = idna_encode(qualify(replacement, self.zone.name))
-        else:
-            replacement = replacement
-
-        data = {
-            'name': name,
-            'ttl': ttl,
-            'record_type': 'NAPTR',
-            'order': order,
-            'preference': preference,
-            'flag': flag,
-            'service': service,
-            'regex': regex,
-            'replacement': replacement,
-        }
-        return '{name:24} {ttl:5} IN {record_type:6} {order} {preference} ' \
-               '\"{flag}\" \"{service}\" \"{regex}\" {replacement}\n'.format_map(data)
+            replacement = self.name(replacement)
+        return NAPTR_FORMAT(name, ttl, 'NAPTR', order, preference, flag,
+                            service, regex, replacement)
 
     def cname_zf_string(self, alias, ttl, target):
         """String representation for zonefile export."""
-        data = {
-            'alias': idna_encode(qualify(alias, self.zone.name)),
-            'ttl': clear_none(ttl),
-            'record_type': 'CNAME',
-            'record_data': target,
-        }
-        return '{alias:24} {ttl:5} IN {record_type:6} {record_data:39}\n'.format_map(data)
-
-    def host_data(self, host):
-        data = ""
+        return RECORD_FORMAT(self.name(alias), clear_none(ttl), 'CNAME', target)
+
+    def host_data(self, host, out):
+        """Append the records of the host to the list out."""
         first = True
-        name_idna = idna_encode(qualify(host.name, self.zone.name))
+        name_idna = self.name(host.name)
         ttl = clear_none(host.ttl)
         for values, func in ((self.ipaddresses, self.ip_zf_string),
                              (self.mxs, self.mx_zf_string),
@@ -156,19 +143,16 @@ class ForwardFile(Common):
                         name = name_idna
                     else:
                         name = ""
-                    data += func(name, ttl, *i)
+                    out.append(func(name, ttl, *i))
 
-
-        # XXX: add caching for this one, if we populate it..
         if host.hinfo is not None:
-            data += host.hinfo.zf_string
+            out.append(host.hinfo.zf_string)
         if host.loc:
-            data += host.loc_string(self.zone.name)
+            out.append(host.loc_string(self.zone.name))
         # For entries where the host is the resource record
         if host.name in self.host_cnames:
             for alias, ttl in self.host_cnames[host.name]:
-                data += self.cname_zf_string(alias, ttl, name_idna)
-        return data
+                out.append(self.cname_zf_string(alias, ttl, name_idna))
 
     def cache_hostdata(self):
         self.host_cnames = defaultdict(list)
@@ -210,79 +194,67 @@ class ForwardFile(Common):
         zone = self.zone
         self.cache_hostdata()
         # Print info about Zone and its nameservers
-        data = zone.zf_string
-        data += ';\n; Name servers\n;\n'
-        for ns in zone.nameservers.all():
-            data += ns.zf_string(zone.name)
-
-        data += self.get_delegations()
-        data += self.get_subdomains()
+        out = [self.get_header(), self.get_subdomains()]
         try:
-            root = Host.objects.get(name=zone.name)
-            root_data = self.host_data(root)
+            root = Host.objects.select_related('hinfo').get(name=zone.name)
+            root_data = []
+            self.host_data(root, root_data)
             if root_data:
-                data += ";\n"
-                data += "@" + root_data
-                data += ";\n"
+                out.append(";\n@")
+                out.extend(root_data)
+                out.append(";\n")
         except Host.DoesNotExist:
             pass
         # Print info about hosts and their corresponding data
         hosts = Host.objects.filter(zone=zone.id).order_by('name')
-        hosts = hosts.exclude(name=zone.name)
+        hosts = hosts.exclude(name=zone.name).select_related('hinfo')
         if hosts:
-            data += ';\n; Host addresses\n;\n'
+            out.append(';\n; Host addresses\n;\n')
             for host in hosts:
-                data += self.host_data(host)
+                self.host_data(host, out)
         # Print misc entries
         srvs = Srv.objects.filter(zone=zone.id)
         if srvs:
-            data += ';\n; Services\n;\n'
+            out.append(';\n; Services\n;\n')
             for srv in srvs:
-                data += srv.zf_string(zone.name)
+                out.append(srv.zf_string(zone.name))
         cnames = Cname.objects.filter(zone=zone.id).exclude(host__zone=zone.id)
+        cnames = cnames.values_list('name', 'ttl', 'host__name')
         if cnames:
-            data += ';\n; Cnames pointing out of the zone\n;\n'
-            for cname in cnames:
-                data += cname.zf_string(zone.name)
-        return data
+            out.append(';\n; Cnames pointing out of the zone\n;\n')
+            for alias, ttl, target in cnames:
+                out.append(self.cname_zf_string(alias, ttl, self.name(target)))
+        return "".join(out)
 
 
 class IPv4ReverseFile(Common):
 
     def generate(self):
         zone = self.zone
-        data = zone.zf_string
-        data += ';\n; Name servers\n;\n'
-        for ns in zone.nameservers.all():
-            data += ns.zf_string(zone.name)
-        data += self.get_delegations()
+        out = [self.get_header()]
         _prev_net = 'z'
         for ip, ttl, hostname in zone.get_ipaddresses():
             rev = ip.reverse_pointer
             # Add $ORIGIN between every new /24 found
             if not rev.endswith(_prev_net):
                 _prev_net = rev[rev.find('.'):]
-                data += "$ORIGIN {}.\n".format(_prev_net[1::])
+                out.append(ORIGIN_FORMAT(_prev_net[1::]))
             ptrip = rev[:rev.find('.')]
-            data += "{} {}\tPTR\t{}.\n".format(ptrip, ttl, idna_encode(hostname))
-        return data
+            out.append(PTR_FORMAT(ptrip, ttl, idna_encode(hostname)))
+        return "".join(out)
 
 
 class IPv6ReverseFile(Common):
 
     def generate(self):
         zone = self.zone
-        data = zone.zf_string
-        data += ';\n; Name servers\n;\n'
-        for ns in zone.nameservers.all():
-            data += ns.zf_string(zone.name)
-        data += self.get_delegations()
+        out = [self.get_header()]
         _prev_net = 'z'
         for ip, ttl, hostname in zone.get_ipaddresses():
             rev = ip.reverse_pointer
             # Add $ORIGIN between every new /64 found
             if not rev.endswith(_prev_net):
                 _prev_net = rev[32:]
-                data += "$ORIGIN {}.\n".format(_prev_net)
-            data += "{} {}\tPTR\t{}.\n".format(rev[:31], ttl, idna_encode(hostname))
-        return data
+                out.append(ORIGIN_FORMAT(_prev_net))
+            out.append(PTR_FORMAT(rev[:31], ttl, idna_encode(hostname)))
+        return "".join(out)
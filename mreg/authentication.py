@@ -1,5 +1,10 @@
+import hashlib
+
 from datetime import timedelta
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
 from rest_framework.authentication import TokenAuthentication
@@ -7,18 +12,76 @@ from rest_framework import exceptions
 
 EXPIRE_HOURS = getattr(settings, 'REST_FRAMEWORK_TOKEN_EXPIRE_HOURS', 8)
 
+# Tokens are cached for TOKEN_CACHE_TIMEOUT seconds in the cache given by
+# TOKEN_CACHE, and invalidated by signals when a token or user is changed.
+# TOKEN_CACHE should be shared by all processes, e.g. memcached. With a per
+# process local memory cache, the default, only the process making the change
+# sees the invalidation, so there entries are kept for at most
+# LOCAL_CACHE_TIMEOUT seconds, which is how long a revoked token or removed
+# group membership can still be used in the other processes.
+TOKEN_CACHE_TIMEOUT = getattr(settings, 'TOKEN_CACHE_TIMEOUT', 60)
+LOCAL_CACHE_TIMEOUT = 5
+USER_FIELDS = ('id', 'username', 'is_active', 'is_staff', 'is_superuser')
+
+
+def _get_cache():
+    return caches[getattr(settings, 'TOKEN_CACHE', 'default')]
+
+
+def get_cache_timeout(cache, timeout):
+    """Return the timeout to use for an entry in the cache, limited to
+    LOCAL_CACHE_TIMEOUT if the cache is local to the process."""
+    if isinstance(cache, LocMemCache):
+        return min(timeout, LOCAL_CACHE_TIMEOUT)
+    return timeout
+
+
+def _get_cache_key(key):
+    # Do not store the token itself in a possibly shared cache
+    return 'token:' + hashlib.sha256(key.encode()).hexdigest()
+
+
+def invalidate_token_cache(key):
+    _get_cache().delete(_get_cache_key(key))
+
+
+def _from_cache(model, fields):
+    """Return an instance of model with the cached {attname: value} fields,
+    with the other fields deferred. from_db() takes the values in the order
+    of the model's fields."""
+    names = [f.attname for f in model._meta.concrete_fields if f.attname in fields]
+    return model.from_db(None, names, [fields[i] for i in names])
+
+
+def _is_expired(created):
+    return created < timezone.now() - timedelta(hours=EXPIRE_HOURS)
+
 
 class ExpiringTokenAuthentication(TokenAuthentication):
     def authenticate_credentials(self, key):
-        try:
-            token = self.get_model().objects.get(key=key)
-        except ObjectDoesNotExist:
-            raise exceptions.AuthenticationFailed('Invalid token')
+        cache = _get_cache()
+        cache_key = _get_cache_key(key)
+        cached = cache.get(cache_key)
+        # An expired token might have been refreshed since it was cached
+        if cached is not None and not _is_expired(cached['created']):
+            user = _from_cache(get_user_model(), cached['user'])
+            token = _from_cache(self.get_model(), {'key': key, 'user_id': user.id,
+                                                   'created': cached['created']})
+            token.user = user
+        else:
+            try:
+                token = self.get_model().objects.select_related('user').get(key=key)
+            except ObjectDoesNotExist:
+                raise exceptions.AuthenticationFailed('Invalid token')
+            user = token.user
+            cached = {'user': {i: getattr(user, i) for i in USER_FIELDS},
+                      'created': token.created}
+            cache.set(cache_key, cached, get_cache_timeout(cache, TOKEN_CACHE_TIMEOUT))
 
-        if not token.user.is_active:
+        if not user.is_active:
             raise exceptions.AuthenticationFailed('User inactive or deleted')
 
-        if token.created < timezone.now() - timedelta(hours=EXPIRE_HOURS):
+        if _is_expired(token.created):
             raise exceptions.AuthenticationFailed('Token has expired')
 
-        return token.user, token
+        return user, token
@@ -0,0 +1,172 @@
+"""
+Batching of the side effects done by the signal handlers in mreg.signals.
+
+The signal handlers work on one instance at a time, which is fine for a
+normal request, but far too slow when hundreds of hosts are changed at once.
+Inside a bulk_operation() the handlers are skipped, and the caller must apply
+the side effects once for the whole set of objects, using the helpers below.
+
+Changes to the PtrOverrides caused by changed IP addresses are done for the
+whole set of addresses with update_ptr_overrides().
+
+Zones marked as updated by the signal handlers inside a transaction are
+collected, and written with one query per zone type when the transaction
+commits, using get_commit_batch(). Nothing is marked if the transaction is
+rolled back.
+"""
+import threading
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.db import models, transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from mreg.models import (Cname, ForwardZone, Host, Ipaddress, PtrOverride,
+        ReverseZone)
+
+_local = threading.local()
+
+
+@contextmanager
+def bulk_operation():
+    """Skip the per instance signal handlers while in this context."""
+    depth = getattr(_local, 'bulk_depth', 0)
+    _local.bulk_depth = depth + 1
+    try:
+        yield
+    finally:
+        _local.bulk_depth = depth
+
+
+def in_bulk_operation():
+    return getattr(_local, 'bulk_depth', 0) > 0
+
+
+def get_zone_ids_for_hosts(host_ids):
+    """Return a tuple with the ids of the forward and the reverse zones which
+    have data from the given hosts."""
+    forward = set(Host.objects.filter(id__in=host_ids, zone__isnull=False)
+                              .values_list('zone', flat=True))
+    forward.update(Cname.objects.filter(host__in=host_ids, zone__isnull=False)
+                                .values_list('zone', flat=True))
+    ips = set(Ipaddress.objects.filter(host__in=host_ids)
+                               .values_list('ipaddress', flat=True))
+    ips.update(PtrOverride.objects.filter(host__in=host_ids)
+                                  .values_list('ipaddress', flat=True))
+    reverse = set()
+    if ips:
+        reverse.update(ReverseZone.get_zones_by_ips(ips).values_list('id', flat=True))
+    return forward, reverse
+
+
+def update_ptr_overrides(removed=(), added=()):
+    """Set based version of the PtrOverride handling in mreg.signals, for
+    Ipaddress objects changed in a bulk_operation(). Must be called before
+    the changes are saved.
+
+    The PtrOverrides of the removed addresses are deleted. added are the new
+    Ipaddress objects, in the order they are saved. As when they are saved
+    one by one, an address which becomes used by a second host gets a
+    PtrOverride for the first, whether that is already in the database or
+    also among the added objects.
+    """
+    removed = set(removed)
+    pending = defaultdict(list)
+    for ip in added:
+        pending[ip.ipaddress].append(ip.host_id)
+    if removed:
+        removed = PtrOverride.objects.filter(ipaddress__in=removed)
+        removed._raw_delete(removed.db)
+    if not pending:
+        return
+    holders = Ipaddress.objects.filter(ipaddress__in=pending).values('ipaddress')
+    holders = holders.annotate(count=Count('id'), host=Min('host'))
+    holders = {i['ipaddress']: i for i in holders}
+    existing = set(PtrOverride.objects.filter(ipaddress__in=pending)
+                                      .values_list('ipaddress', flat=True))
+    overrides = []
+    for ipaddress, hosts in pending.items():
+        holder = holders.get(ipaddress)
+        if holder is None:
+            # The first added object is the only holder when the next is added
+            host = hosts[0] if len(hosts) > 1 else None
+        else:
+            host = holder['host'] if holder['count'] == 1 else None
+        if host is not None and ipaddress not in existing:
+            overrides.append(PtrOverride(host_id=host, ipaddress=ipaddress))
+    PtrOverride.objects.bulk_create(overrides)
+
+
+def delete_hosts(host_ids):
+    """Delete the hosts and the objects referring to them, with one query per
+    table. QuerySet.delete() fetches the objects to send their signals, and
+    deletes them in chunks of 100, so it needs more queries the more hosts
+    there are. No signals are sent, so this must be done in a
+    bulk_operation(), with the side effects handled by the caller."""
+    for related in Host._meta.related_objects:
+        if related.on_delete is models.CASCADE:
+            objs = related.related_model.objects.filter(
+                    **{f'{related.field.name}__in': host_ids})
+            objs._raw_delete(objs.db)
+    hosts = Host.objects.filter(id__in=host_ids)
+    hosts._raw_delete(hosts.db)
+
+
+def mark_zones_updated(forward_ids, reverse_ids):
+    """Set the updated flag on the given zones, with one query per zone
+    type."""
+    now = timezone.now()
+    for model, ids in ((ForwardZone, forward_ids), (ReverseZone, reverse_ids)):
+        if ids:
+            model.objects.filter(id__in=ids).update(updated=True, updated_at=now)
+
+
+def get_commit_batch(name, factory, flush):
+    """Return the data collected under name for the current transaction,
+    made by factory() on first use, when flush(data) is registered to be run
+    when the transaction commits. Returns None in autocommit mode, where the
+    caller should write at once.
+
+    If the transaction, or the savepoint the flush was registered in, is
+    rolled back, the flush is dropped and a new batch is started. Data added
+    in a later savepoint which is rolled back is still flushed.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        return None
+    callback = getattr(_local, name, None)
+    if callback is None or \
+            not any(func is callback for sids, func in connection.run_on_commit):
+        data = factory()
+
+        def callback():
+            if getattr(_local, name, None) is callback:
+                setattr(_local, name, None)
+            flush(data)
+
+        callback.data = data
+        setattr(_local, name, callback)
+        transaction.on_commit(callback)
+    return callback.data
+
+
+def _flush_updated_zones(pending):
+    mark_zones_updated(*pending)
+
+
+def add_updated_zones(forward_ids=(), reverse_ids=()):
+    """Mark zones as updated. Inside a transaction the zones are marked when
+    it commits, once for all the changes in it, else at once."""
+    forward_ids = {i for i in forward_ids if i is not None}
+    reverse_ids = {i for i in reverse_ids if i is not None}
+    if not forward_ids and not reverse_ids:
+        return
+    pending = get_commit_batch('pending_zones', lambda: (set(), set()),
+                               _flush_updated_zones)
+    if pending is None:
+        mark_zones_updated(forward_ids, reverse_ids)
+    else:
+        pending[0].update(forward_ids)
+        pending[1].update(reverse_ids)
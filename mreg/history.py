@@ -0,0 +1,324 @@
+"""
+Host history logging.
+
+Changes to a host and its related objects inside a transaction are
+collected, and one snapshot per changed host is written with a single bulk
+insert when the transaction commits, see mreg.batch.get_commit_batch().
+Nothing is logged for a rolled back transaction. In autocommit mode the
+entry is written at once.
+
+If HOST_HISTORY_QUEUE is set, the committed changes are instead handed to a
+background thread, which takes the snapshots and writes them, keeping them
+off the request path. This is best-effort: the queue is only kept in memory,
+and entries still in it are lost if the process exits or the write fails.
+
+Snapshots are stored as JSON. Only every HOST_HISTORY_SNAPSHOT_INTERVAL
+entry for a host is a full snapshot, the others are diffs against the
+previous entry, on the form {"set": {key: value}, "unset": [key]}. Entries
+from before the JSON format are treated as full snapshots which can not be
+diffed against.
+
+Old entries can be removed with prune_history(), which keeps the remaining
+history of each row readable, and the newest entry of each row which has not
+been deleted.
+"""
+import io
+import json
+import logging
+import os
+import queue
+import threading
+
+from itertools import groupby
+from operator import itemgetter
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, transaction
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+
+from mreg.api.v1.serializers import HostSerializer, prefetch_host_data
+from mreg.batch import get_commit_batch
+from mreg.models import Host, ModelChangeLog
+
+logger = logging.getLogger(__name__)
+
+_queue = None
+_queue_lock = threading.Lock()
+
+HISTORY_FIELDS = ('id', 'table_name', 'table_row', 'data', 'action', 'timestamp')
+
+
+def get_host_history_data(host):
+    """Return a snapshot of the host and its related data for the history
+    log."""
+    hostdata = HostSerializer(host).data
+
+    # Cleaning up data from related tables
+    hostdata['ipaddresses'] = [record['ipaddress'] for record in hostdata['ipaddresses']]
+    hostdata['txts'] = [record['txt'] for record in hostdata['txts']]
+    hostdata['cnames'] = [record['name'] for record in hostdata['cnames']]
+    hostdata['ptr_overrides'] = [record['ipaddress'] for record in hostdata['ptr_overrides']]
+    return hostdata
+
+
+def _get_hosts(host_ids):
+    return prefetch_host_data(Host.objects.filter(id__in=host_ids))
+
+
+def log_host_history(hosts, action):
+    """Add a history entry for each of the hosts now, using a single
+    insert."""
+    pending = {host.id: (action, get_host_history_data(host))
+               for host in prefetch_host_data(hosts)}
+    _write_host_history(pending, timezone.now())
+
+
+def _load_data(data):
+    """Return the JSON data as a dict, or None for entries from before the
+    JSON format."""
+    try:
+        data = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    return data
+
+
+def _make_delta(old, new):
+    return {'set': {key: value for key, value in new.items()
+                    if key not in old or old[key] != value},
+            'unset': [key for key in old if key not in new]}
+
+
+def _apply_delta(old, delta):
+    data = dict(old)
+    data.update(delta['set'])
+    for key in delta['unset']:
+        data.pop(key, None)
+    return data
+
+
+def _get_latest_versions(table_name, rows):
+    """Return a dict of row to a tuple of the number of entries since the
+    last full snapshot, and the latest version of the data. Rows without
+    any usable snapshot are left out."""
+    last_full = ModelChangeLog.objects.filter(table_name=table_name,
+                                              table_row=OuterRef('table_row'),
+                                              delta=False)
+    last_full = last_full.order_by('-id').values('id')[:1]
+    entries = ModelChangeLog.objects.filter(table_name=table_name, table_row__in=rows)
+    entries = entries.annotate(last_full=Subquery(last_full)).filter(id__gte=F('last_full'))
+
+    ret = {}
+    for row, data, delta in entries.order_by('id').values_list('table_row', 'data', 'delta'):
+        data = _load_data(data)
+        if delta:
+            if row in ret:
+                count, latest = ret[row]
+                ret[row] = (count + 1, _apply_delta(latest, data))
+        elif data is None:
+            ret.pop(row, None)
+        else:
+            ret[row] = (1, data)
+    return ret
+
+
+def _write_host_history(pending, timestamp):
+    """Write the pending entries, given as a dict of host id to a tuple of
+    action and an optional snapshot. Hosts without a snapshot are serialized
+    now, and skipped if they no longer exist.
+
+    The hosts are locked while their latest versions are read and the new
+    entries written, so that concurrent writers do not both make a delta
+    against the same entry."""
+    entries = []
+    interval = getattr(settings, 'HOST_HISTORY_SNAPSHOT_INTERVAL', 10)
+    with transaction.atomic():
+        list(Host.objects.filter(id__in=list(pending)).order_by('id')
+                         .select_for_update().values_list('id', flat=True))
+        snapshots = {host_id: data for host_id, (action, data) in pending.items()
+                     if data is not None}
+        missing = [host_id for host_id in pending if host_id not in snapshots]
+        for host in _get_hosts(missing):
+            snapshots[host.id] = get_host_history_data(host)
+        latest = _get_latest_versions('host', list(snapshots))
+        for host_id in sorted(snapshots):
+            data = json.loads(json.dumps(snapshots[host_id], cls=DjangoJSONEncoder))
+            delta = False
+            if host_id in latest:
+                count, previous = latest[host_id]
+                if count < interval:
+                    data = _make_delta(previous, data)
+                    delta = True
+            entries.append(ModelChangeLog(table_name='host',
+                                          table_row=host_id,
+                                          data=json.dumps(data),
+                                          delta=delta,
+                                          action=pending[host_id][0],
+                                          timestamp=timestamp))
+        ModelChangeLog.objects.bulk_create(entries)
+
+
+def get_history(table_name, table_row):
+    """Return all entries for the row ordered by time. The data of each
+    entry is reconstructed to a full snapshot, and returned in the string
+    form used before the JSON format, as the entries from before it are."""
+    ret = []
+    latest = None
+    entries = ModelChangeLog.objects.filter(table_name=table_name, table_row=table_row)
+    # Deltas are made in insert order, which might differ from the
+    # timestamp order when written by the background thread.
+    for entry in entries.order_by('id').values(*HISTORY_FIELDS, 'delta'):
+        delta = entry.pop('delta')
+        data = _load_data(entry['data'])
+        if delta:
+            if latest is None:
+                # Should not happen, unless the full snapshot is removed
+                continue
+            latest = _apply_delta(latest, data)
+        else:
+            latest = data
+        if latest is not None:
+            entry['data'] = str(latest)
+        ret.append(entry)
+    return sorted(ret, key=lambda i: i['timestamp'])
+
+
+def _prune_row(entries, cutoff):
+    """Return the entries of a row, given in id order, which are older than
+    cutoff and should be deleted, and a dict of id to the full data of the
+    remaining deltas which follow a deleted entry, and must be rewritten as
+    snapshots. The newest entry is kept, so that a concurrent writer never
+    makes a delta against a deleted entry, unless the row was deleted."""
+    entries = list(entries)
+    delete = []
+    snapshots = {}
+    data = None
+    previous_deleted = False
+    for entry in entries:
+        entry_data = _load_data(entry['data'])
+        if not entry['delta']:
+            data = entry_data
+        elif data is not None:
+            data = _apply_delta(data, entry_data)
+        newest = entry is entries[-1] and entry['action'] != 'deleted'
+        if entry['timestamp'] < cutoff and not newest:
+            delete.append(entry)
+            previous_deleted = True
+        else:
+            if entry['delta'] and previous_deleted and data is not None:
+                snapshots[entry['id']] = data
+            previous_deleted = False
+    return delete, snapshots
+
+
+def _sync_archive(archive):
+    archive.flush()
+    try:
+        fileno = archive.fileno()
+    except io.UnsupportedOperation:
+        return
+    os.fsync(fileno)
+
+
+def _delete_entries(entries, snapshots, archive):
+    """Archive and delete the entries, and rewrite the given entries as
+    snapshots. The archive is synced to disk before anything is deleted."""
+    if not entries:
+        return 0
+    if archive is not None:
+        for entry in entries:
+            archive.write(json.dumps(entry, cls=DjangoJSONEncoder) + '\n')
+        _sync_archive(archive)
+    with transaction.atomic():
+        for entry_id, data in snapshots.items():
+            ModelChangeLog.objects.filter(id=entry_id).update(data=json.dumps(data), delta=False)
+        ModelChangeLog.objects.filter(id__in=[i['id'] for i in entries]).delete()
+    return len(entries)
+
+
+def prune_history(cutoff, archive=None, batch_size=10000):
+    """Delete the history entries older than cutoff, in transactions of
+    about batch_size entries, and return the number of deleted entries.
+
+    The entries of the rows with old entries are read in a single pass,
+    ordered by row and id, and each remaining delta following a deleted
+    entry is rewritten as a full snapshot, as it can not be read without it.
+    If archive is given, the deleted entries are written to it as JSON, one
+    per line, and synced to disk before they are deleted.
+    """
+    fields = HISTORY_FIELDS + ('delta',)
+    old = ModelChangeLog.objects.filter(timestamp__lt=cutoff)
+    deleted = 0
+    delete = []
+    snapshots = {}
+    for table_name in list(old.order_by().values_list('table_name', flat=True).distinct()):
+        rows = old.filter(table_name=table_name).values('table_row')
+        entries = ModelChangeLog.objects.filter(table_name=table_name, table_row__in=rows)
+        entries = entries.order_by('table_row', 'id').values(*fields).iterator()
+        for row, row_entries in groupby(entries, key=itemgetter('table_row')):
+            row_delete, row_snapshots = _prune_row(row_entries, cutoff)
+            delete.extend(row_delete)
+            snapshots.update(row_snapshots)
+            if len(delete) >= batch_size:
+                deleted += _delete_entries(delete, snapshots, archive)
+                delete = []
+                snapshots = {}
+    deleted += _delete_entries(delete, snapshots, archive)
+    return deleted
+
+
+def _history_worker(work_queue):
+    while True:
+        pending, timestamp = work_queue.get()
+        try:
+            close_old_connections()
+            _write_host_history(pending, timestamp)
+        except Exception:
+            logger.exception("Failed to write host history")
+        finally:
+            work_queue.task_done()
+
+
+def _get_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = queue.Queue()
+            worker = threading.Thread(target=_history_worker, args=(_queue,),
+                                      name='mreg-host-history', daemon=True)
+            worker.start()
+    return _queue
+
+
+def _flush_host_history(pending):
+    if not pending:
+        return
+    # A host deleted in a savepoint which was rolled back is still there,
+    # and is logged as saved instead.
+    deleted = [host_id for host_id, (action, data) in pending.items() if data is not None]
+    if deleted:
+        for host_id in Host.objects.filter(id__in=deleted).values_list('id', flat=True):
+            pending[host_id] = ('saved', None)
+    timestamp = timezone.now()
+    if getattr(settings, 'HOST_HISTORY_QUEUE', False):
+        _get_queue().put((pending, timestamp))
+    else:
+        _write_host_history(pending, timestamp)
+
+
+def add_host_history(host_id, action, data=None):
+    """Register a change of the host for the history log, written when the
+    current transaction commits, or at once in autocommit mode. A host
+    which has been given a snapshot when deleted keeps it, as the host is
+    gone when the transaction commits."""
+    pending = get_commit_batch('pending_history', dict, _flush_host_history)
+    if pending is None:
+        _flush_host_history({host_id: (action, data)})
+        return
+    if host_id in pending and pending[host_id][1] is not None:
+        return
+    pending[host_id] = (action, data)
@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from mreg.models import DhcpChange
+
+
+class Command(BaseCommand):
+    help = 'Delete DHCP changes older than the retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=getattr(settings, 'DHCP_CHANGES_RETENTION_DAYS', None),
+                            help='Number of days to keep. Defaults to DHCP_CHANGES_RETENTION_DAYS.')
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if days is None:
+            raise CommandError('No retention period given, use --days or set DHCP_CHANGES_RETENTION_DAYS')
+        if days < 0:
+            raise CommandError('--days must be positive')
+        cutoff = timezone.now() - timedelta(days=days)
+        # Only numbered changes are pruned
+        DhcpChange.number_changes()
+        deleted = DhcpChange.prune(cutoff)
+        self.stdout.write(f'Deleted {deleted} DHCP changes older than {cutoff}')
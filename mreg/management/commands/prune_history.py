@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from mreg.history import prune_history
+
+
+class Command(BaseCommand):
+    help = 'Delete history entries older than the retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=getattr(settings, 'HISTORY_RETENTION_DAYS', None),
+                            help='Number of days to keep. Defaults to HISTORY_RETENTION_DAYS.')
+        parser.add_argument('--archive',
+                            help='Append the deleted entries to this file, as JSON lines.')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Number of entries to delete per transaction.')
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if days is None:
+            raise CommandError('No retention period given, use --days or set HISTORY_RETENTION_DAYS')
+        if days < 0 or options['batch_size'] < 1:
+            raise CommandError('--days and --batch-size must be positive')
+        cutoff = timezone.now() - timedelta(days=days)
+        if options['archive']:
+            with open(options['archive'], 'a') as archive:
+                deleted = prune_history(cutoff, archive=archive,
+                                        batch_size=options['batch_size'])
+        else:
+            deleted = prune_history(cutoff, batch_size=options['batch_size'])
+        self.stdout.write(f'Deleted {deleted} history entries older than {cutoff}')
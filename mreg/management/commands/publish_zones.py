@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from mreg.publish import publish_zones
+
+
+class Command(BaseCommand):
+    help = 'Update the serial numbers of updated zones, and publish their zonefiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int,
+                            help='Keep running, publishing every INTERVAL seconds.')
+        parser.add_argument('--workers', type=int,
+                            help='Number of processes rendering zones. '
+                                 'Defaults to ZONEFILE_RENDER_WORKERS.')
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        if interval is not None and interval < 1:
+            raise CommandError('--interval must be positive')
+        if options['workers'] is not None and options['workers'] < 1:
+            raise CommandError('--workers must be positive')
+        while True:
+            close_old_connections()
+            rendered = publish_zones(workers=options['workers'])
+            if options['verbosity'] > 1 or interval is None:
+                self.stdout.write(f'Published {rendered} zones')
+            if interval is None:
+                break
+            time.sleep(interval)
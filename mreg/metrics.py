@@ -0,0 +1,103 @@
+"""
+Request metrics, exported in the Prometheus text format on /metrics.
+
+The metrics are collected per process by mreg.middleware.MetricsMiddleware,
+so with several worker processes each must be scraped, or the numbers will
+only be those of the process answering. /metrics is only answered for the
+addresses in METRICS_ALLOWED_IPS.
+"""
+import threading
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+
+
+class Counter:
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = defaultdict(float)
+
+    def inc(self, labels, value=1):
+        with _lock:
+            self.values[labels] += value
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help_text}'
+        yield f'# TYPE {self.name} counter'
+        for labels, value in sorted(self.values.items()):
+            yield f'{self.name}{{{_format_labels(self.labels, labels)}}} {value}'
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [bucket counts..., count, sum]
+        self.values = dict()
+
+    def observe(self, labels, value):
+        with _lock:
+            if labels not in self.values:
+                self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            data = self.values[labels]
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    data[i] += 1
+            data[-2] += 1
+            data[-1] += value
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help_text}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, data in sorted(self.values.items()):
+            labels = _format_labels(self.labels, labels)
+            for bucket, count in zip(self.buckets, data):
+                yield f'{self.name}_bucket{{{labels},le="{bucket}"}} {count}'
+            yield f'{self.name}_bucket{{{labels},le="+Inf"}} {data[-2]}'
+            yield f'{self.name}_count{{{labels}}} {data[-2]}'
+            yield f'{self.name}_sum{{{labels}}} {data[-1]}'
+
+
+def _format_labels(names, values):
+    values = (str(i).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+              for i in values)
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+
+
+REQUESTS = Counter('mreg_requests_total', 'Number of requests.',
+                   ('view', 'method', 'status'))
+REQUEST_DURATION = Histogram('mreg_request_duration_seconds', 'Request latency.',
+                             ('view',))
+DB_QUERIES = Counter('mreg_db_queries_total', 'Number of SQL queries.', ('view',))
+DB_DURATION = Counter('mreg_db_query_duration_seconds_total', 'Time spent in SQL queries.',
+                      ('view',))
+RESPONSE_BYTES = Counter('mreg_response_bytes_total', 'Size of response bodies.',
+                         ('view',))
+ZONEFILE_RENDER_DURATION = Histogram('mreg_zonefile_render_seconds',
+                                     'Time spent rendering zonefiles.', ('zone',))
+
+METRICS = (REQUESTS, REQUEST_DURATION, DB_QUERIES, DB_DURATION, RESPONSE_BYTES,
+           ZONEFILE_RENDER_DURATION)
+
+
+def render_metrics():
+    with _lock:
+        lines = [line for metric in METRICS for line in metric.render()]
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    allowed = getattr(settings, 'METRICS_ALLOWED_IPS', ('127.0.0.1', '::1'))
+    if request.META.get('REMOTE_ADDR') not in allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4')
@@ -0,0 +1,199 @@
+import cProfile
+import json
+import logging
+import os
+import random
+import time
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
+
+from mreg import metrics
+from mreg.authentication import ExpiringTokenAuthentication
+
+logger = logging.getLogger(__name__)
+
+
+def stream_with(content, context, done):
+    """Return a generator over the streaming content, which runs each step
+    of it in context(), and calls done(size) with the number of bytes when
+    the content is exhausted or closed. Used to measure streaming responses,
+    whose content is made after the middleware has returned."""
+    size = 0
+    content = iter(content)
+    try:
+        while True:
+            with context():
+                chunk = next(content, None)
+            if chunk is None:
+                break
+            size += len(chunk)
+            yield chunk
+    finally:
+        done(size)
+
+
+class MetricsMiddleware:
+    """
+    Collect request count, latency, SQL queries and response size per view
+    class, see mreg.metrics. For streaming responses, the time and queries
+    used making the content are included when the content has been sent.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = [0, 0.0]
+
+        def count_queries(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries[0] += 1
+                queries[1] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(count_queries):
+            response = self.get_response(request)
+
+        def done(size):
+            view = get_view_name(request)
+            metrics.REQUESTS.inc((view, request.method, response.status_code))
+            metrics.REQUEST_DURATION.observe((view,), time.perf_counter() - start)
+            metrics.DB_QUERIES.inc((view,), queries[0])
+            metrics.DB_DURATION.inc((view,), queries[1])
+            metrics.RESPONSE_BYTES.inc((view,), size)
+
+        if getattr(response, 'file_to_stream', None) is not None:
+            # Wrapping the file would stop it from being sent with the
+            # server's file wrapper, and reading it makes no queries.
+            done(int(response.get('Content-Length', 0)))
+        elif response.streaming:
+            response.streaming_content = stream_with(
+                response.streaming_content,
+                lambda: connection.execute_wrapper(count_queries), done)
+        else:
+            done(len(response.content))
+        return response
+
+
+def get_view_name(request):
+    """Return the name of the view class or function handling the
+    request."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unknown'
+    func = getattr(match.func, 'view_class', match.func)
+    return getattr(func, '__name__', 'unknown')
+
+
+def is_staff_request(request):
+    """Return True if the request is made by a staff user. The token is
+    authenticated here, as the views only do it after the middleware."""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user.is_staff
+    try:
+        auth = ExpiringTokenAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return False
+    return auth is not None and auth[0].is_staff
+
+
+class ProfilingMiddleware:
+    """
+    Profile requests with cProfile, and save the profile and the SQL queries
+    to PROFILE_DIR/<view>/<timestamp>-<pid>.prof and .sql.json. Does nothing
+    unless PROFILE_DIR is set. Saved are:
+
+    - a random PROFILE_SAMPLE_RATE fraction of the requests.
+    - requests taking at least PROFILE_SLOW_THRESHOLD seconds. While it is
+      set every request is profiled, which makes them slower.
+    - requests from staff users with the X-Mreg-Profile header.
+
+    The queries are saved without their parameters, which might hold tokens
+    and passwords. The profiles can be read with python -m pstats. Streaming
+    responses are saved when their content has been sent, and include
+    making it.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        directory = getattr(settings, 'PROFILE_DIR', None)
+        if not directory:
+            return self.get_response(request)
+        sampled = random.random() < getattr(settings, 'PROFILE_SAMPLE_RATE', 0.0)
+        threshold = getattr(settings, 'PROFILE_SLOW_THRESHOLD', None)
+        # Only profile on request for staff users, as profiling makes the
+        # request slower for anyone able to send the header.
+        requested = 'HTTP_X_MREG_PROFILE' in request.META and is_staff_request(request)
+        if not (sampled or requested or threshold is not None):
+            return self.get_response(request)
+
+        queries = []
+
+        def log_queries(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries.append({'sql': sql, 'many': many,
+                                'duration': time.perf_counter() - start})
+
+        profiler = cProfile.Profile()
+
+        @contextmanager
+        def profiling():
+            with connection.execute_wrapper(log_queries):
+                profiler.enable()
+                try:
+                    yield
+                finally:
+                    profiler.disable()
+
+        start = time.perf_counter()
+        with profiling():
+            response = self.get_response(request)
+
+        def done(size):
+            duration = time.perf_counter() - start
+            slow = threshold is not None and duration >= threshold
+            if sampled or requested or slow:
+                info = {'method': request.method,
+                        'path': request.get_full_path(),
+                        'status': response.status_code,
+                        'duration': duration,
+                        'queries': queries}
+                try:
+                    save_profile(directory, get_view_name(request), profiler, info)
+                except OSError:
+                    logger.exception("Failed to save profile")
+
+        if response.streaming and getattr(response, 'file_to_stream', None) is None:
+            response.streaming_content = stream_with(response.streaming_content,
+                                                     profiling, done)
+        else:
+            done(None)
+        return response
+
+
+def save_profile(directory, view, profiler, info):
+    """Save the profile and the request info, and return the path of the
+    profile."""
+    directory = os.path.join(directory, view)
+    os.makedirs(directory, exist_ok=True)
+    name = os.path.join(directory, '{}-{}'.format(timezone.now().strftime('%Y%m%dT%H%M%S.%f'),
+                                                  os.getpid()))
+    profiler.dump_stats(name + '.prof')
+    with open(name + '.sql.json', 'w') as f:
+        json.dump(info, f, indent=1)
+    return name + '.prof'
+
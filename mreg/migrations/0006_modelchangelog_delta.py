@@ -0,0 +1,18 @@
+# Generated by Django 2.1.7 on 2019-03-04 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0005_auto_20190226_0846'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='modelchangelog',
+            name='delta',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.1.7 on 2019-03-05 10:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0006_modelchangelog_delta'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='modelchangelog',
+            index=models.Index(fields=['table_name', 'table_row', 'timestamp'], name='model_change_log_row_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='modelchangelog',
+            index=models.Index(fields=['timestamp'], name='model_change_log_time_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.1.7 on 2019-03-12 09:14
+
+from django.db import migrations, models
+
+
+def create_counter(apps, schema_editor):
+    DhcpChangeCounter = apps.get_model('mreg', 'DhcpChangeCounter')
+    DhcpChangeCounter.objects.create(id=1, counter=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0007_modelchangelog_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DhcpChangeCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('counter', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'dhcp_change_counter',
+            },
+        ),
+        migrations.RunPython(create_counter, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.1.7 on 2019-03-14 13:02
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0008_dhcpchangecounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DhcpChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.BigIntegerField(unique=True)),
+                ('action', models.CharField(max_length=16)),
+                ('hostname', models.CharField(blank=True, max_length=253)),
+                ('ipaddress', models.GenericIPAddressField()),
+                ('macaddress', models.CharField(max_length=17)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'db_table': 'dhcp_change',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.7 on 2019-03-20 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mreg', '0009_dhcpchange'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dhcpchange',
+            name='seq',
+            field=models.BigIntegerField(null=True, unique=True),
+        ),
+    ]
@@ -3,7 +3,10 @@ import ipaddress
 from collections import defaultdict
 from datetime import timedelta
 
-from django.db import DatabaseError, models, transaction
+from django.db import DatabaseError, connection, models, transaction
+from django.db.models import (BigIntegerField, Case, Count, IntegerField, Max,
+        Min, OuterRef, Q, Subquery, Value, When)
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 from mreg.validators import (validate_hostname, validate_reverse_zone_name,
@@ -14,6 +17,13 @@ from mreg.validators import (validate_hostname, validate_reverse_zone_name,
 from mreg.utils import (create_serialno, encode_mail, clear_none, qualify,
         idna_encode, get_network_from_zonename)
 
+# Record formats used by the zf_string methods, as bound format methods to
+# avoid building a dict and parsing the template for each record.
+NS_FORMAT = '{:24} {:5} IN {:6} {}\n'.format
+HINFO_FORMAT = '                                  {:6} {} {}\n'.format
+LOC_FORMAT = '{:30} IN {:6} {}\n'.format
+SRV_FORMAT = '{:24} {:5} IN {:6} {} {} {} {}\n'.format
+
 
 class NameServer(models.Model):
     name = models.CharField(unique=True, max_length=253, validators=[validate_hostname])
@@ -30,46 +40,48 @@ class NameServer(models.Model):
         """String representation for zonefile export."""
         if subzone:
             subzone = idna_encode(qualify(subzone, zone))
-        data = {
-            'subzone': clear_none(subzone),
-            'ttl': clear_none(self.ttl),
-            'record_type': 'NS',
-            'record_data': idna_encode(qualify(self.name, zone))
-        }
-        return '{subzone:24} {ttl:5} IN {record_type:6} {record_data}\n'.format_map(data)
+        return NS_FORMAT(clear_none(subzone), clear_none(self.ttl), 'NS',
+                         idna_encode(qualify(self.name, zone)))
 
     @staticmethod
     def validate_name(name):
         validate_hostname(name)
 
+    @staticmethod
+    def with_usedcount():
+        """Return the nameservers annotated with usedcount, the number of
+        zones and delegations using each of them, in a single query."""
+        usedcount = None
+        for model in (ForwardZone, ReverseZone, ForwardZoneDelegation,
+                      ReverseZoneDelegation):
+            count = model.nameservers.through.objects.filter(nameserver=OuterRef('pk'))
+            count = count.order_by().values('nameserver').annotate(count=Count('*'))
+            count = Coalesce(Subquery(count.values('count'), output_field=IntegerField()), 0)
+            usedcount = count if usedcount is None else usedcount + count
+        return NameServer.objects.annotate(usedcount=usedcount)
+
+    @staticmethod
+    def get_in_use(names):
+        """Return the nameservers with the given names which are used by
+        any zone or delegation."""
+        return NameServer.with_usedcount().filter(name__in=names, usedcount__gt=0)
+
 
 class ZoneHelpers:
     def update_nameservers(self, new_ns):
-        existing = set([i.name for i in self.nameservers.all()])
-        remove_ns = existing - set(new_ns)
-        add_ns = set(new_ns) - existing
-
-        # Remove ns from zone and also delete the NameServer if only
-        # used by this zone.
-        for ns in remove_ns:
-            ns = NameServer.objects.get(name=ns)
-            usedcount = 0
-            #Must check all zone sets
-            for i in ('forwardzone', 'reversezone', 'forwardzonedelegation',
-                      'reversezonedelegation'):
-                usedcount += getattr(ns, f"{i}_set").count()
-
-            if usedcount == 1:
-                ns.delete()
-            self.nameservers.remove(ns)
-
-        for ns in add_ns:
-            try:
-                ns = NameServer.objects.get(name=ns)
-            except NameServer.DoesNotExist:
-                ns = NameServer(name=ns)
-                ns.save()
-            self.nameservers.add(ns)
+        new_ns = set(new_ns)
+        remove_ns = set(self.nameservers.values_list('name', flat=True)) - new_ns
+
+        nameservers = list(NameServer.objects.filter(name__in=new_ns))
+        missing = new_ns - set(ns.name for ns in nameservers)
+        if missing:
+            nameservers += NameServer.objects.bulk_create(
+                    NameServer(name=ns) for ns in sorted(missing))
+        self.nameservers.set(nameservers)
+
+        # Delete the removed nameservers which are no longer used by any zone.
+        if remove_ns:
+            NameServer.with_usedcount().filter(name__in=remove_ns, usedcount=0).delete()
         self.save()
 
     def remove_nameservers(self):
@@ -144,6 +156,27 @@ $TTL {ttl}
             except DatabaseError:
                 pass
 
+    @classmethod
+    def update_serialnos(cls):
+        """Batched version of update_serialno(), for all the updated zones.
+        Uses a single UPDATE, which skips zones changed since they were read,
+        and returns the number of zones updated."""
+        now = timezone.now()
+        min_delta = timedelta(minutes=1)
+        zones = cls.objects.filter(updated=True, serialno_updated_at__lt=now - min_delta)
+        zones = zones.values_list('id', 'serialno', 'updated_at')
+        if not zones:
+            return 0
+        unchanged = Q()
+        serialnos = []
+        for zone_id, serialno, updated_at in zones:
+            unchanged |= Q(id=zone_id, updated_at=updated_at)
+            serialnos.append(When(id=zone_id, then=Value(create_serialno(serialno))))
+        serialno = Case(*serialnos, output_field=BigIntegerField())
+        return cls.objects.filter(unchanged).update(serialno=serialno,
+                                                    serialno_updated_at=now,
+                                                    updated=False)
+
 
 class ForwardZone(BaseZone):
     name = models.CharField(unique=True, max_length=253, validators=[validate_hostname])
@@ -203,6 +236,12 @@ class ReverseZone(BaseZone):
         where = [ "inet %s <<= range::inet" ]
         return ReverseZone.objects.extra(where=where, params=[str(ip)]).first()
 
+    @staticmethod
+    def get_zones_by_ips(ips):
+        """Search and return all zones which contain any of the IP addresses."""
+        where = [ "range::inet >>= ANY(%s::inet[])" ]
+        return ReverseZone.objects.extra(where=where, params=[[str(ip) for ip in ips]])
+
     def get_ipaddresses(self):
         network = self.network
         from_ip = str(network.network_address)
@@ -294,12 +333,7 @@ class HinfoPreset(models.Model):
     @property
     def zf_string(self):
         """String representation for zonefile export."""
-        data = {
-            'record_type': 'HINFO',
-            'cpu': self.cpu,
-            'os': self.os
-        }
-        return '                                  {record_type:6} {cpu} {os}\n'.format_map(data)
+        return HINFO_FORMAT('HINFO', self.cpu, self.os)
 
 
 class Host(ForwardZoneMember):
@@ -319,12 +353,7 @@ class Host(ForwardZoneMember):
 
     def loc_string(self, zone):
         """String representation for zonefile export."""
-        data = {
-            'name': idna_encode(qualify(self.name, zone)),
-            'record_type': 'LOC',
-            'record_data': self.loc
-        }
-        return '{name:30} IN {record_type:6} {record_data}\n'.format_map(data)
+        return LOC_FORMAT(idna_encode(qualify(self.name, zone)), 'LOC', self.loc)
 
 
 class Ipaddress(models.Model):
@@ -531,16 +560,9 @@ class Srv(ForwardZoneMember):
 
     def zf_string(self, zone):
         """String representation for zonefile export."""
-        data = {
-            'name': idna_encode(qualify(self.name, zone)),
-            'ttl': clear_none(self.ttl),
-            'record_type': 'SRV',
-            'priority': self.priority,
-            'weight': self.weight,
-            'port': self.port,
-            'target': idna_encode(qualify(self.target, zone))
-        }
-        return '{name:24} {ttl:5} IN {record_type:6} {priority} {weight} {port} {target}\n'.format_map(data)
+        return SRV_FORMAT(idna_encode(qualify(self.name, zone)), clear_none(self.ttl),
+                          'SRV', self.priority, self.weight, self.port,
+                          idna_encode(qualify(self.target, zone)))
 
 
 # TODO: Add user_id functionality when auth is implemented
@@ -549,8 +571,100 @@ class ModelChangeLog(models.Model):
     table_name = models.CharField(max_length=132)
     table_row = models.BigIntegerField()
     data = models.TextField()
+    # If set, data is a JSON diff against the previous entry for the row,
+    # instead of a full snapshot. See mreg.history.
+    delta = models.BooleanField(default=False)
     action = models.CharField(max_length=16)  # saved or deleted
     timestamp = models.DateTimeField()
 
     class Meta:
         db_table = "model_change_log"
+        indexes = [
+            models.Index(fields=['table_name', 'table_row', 'timestamp'],
+                         name='model_change_log_row_idx'),
+            models.Index(fields=['timestamp'],
+                         name='model_change_log_time_idx'),
+        ]
+
+
+class DhcpChangeCounter(models.Model):
+    """The sequence number of the latest numbered DhcpChange. Used as ETag
+    for the DHCP exports. Has a single row."""
+    counter = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = 'dhcp_change_counter'
+
+    @classmethod
+    def get_value(cls):
+        return cls.objects.filter(id=1).values_list('counter', flat=True).first() or 0
+
+
+class DhcpChange(models.Model):
+    """A reservation added or changed (saved), or removed (deleted), for the
+    DHCP change feed.
+
+    The changes are added without a sequence number, so writers do not take
+    any shared lock. The readers number the committed changes with
+    number_changes() before reading them. As only committed changes are
+    numbered, and the numbering is serialized, a reader which has seen a
+    sequence number never misses a change with a lower one."""
+    seq = models.BigIntegerField(unique=True, null=True)
+    action = models.CharField(max_length=16)
+    hostname = models.CharField(max_length=253, blank=True)
+    ipaddress = models.GenericIPAddressField()
+    macaddress = models.CharField(max_length=17)
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = 'dhcp_change'
+
+    @classmethod
+    def log(cls, changes):
+        """Add the changes, given as a list of (action, host name, IP
+        address, MAC address)."""
+        if not changes:
+            return
+        cls.objects.bulk_create(
+            cls(action=action, hostname=hostname or '', ipaddress=ip, macaddress=mac)
+            for action, hostname, ip, mac in changes)
+
+    @classmethod
+    def number_changes(cls):
+        """Give the committed changes without a sequence number the next
+        numbers, in the order they were added, and return the latest
+        sequence number. The counter row is only locked while numbering."""
+        if not cls.objects.filter(seq__isnull=True).exists():
+            return DhcpChangeCounter.get_value()
+        with transaction.atomic():
+            counter, created = DhcpChangeCounter.objects.select_for_update() \
+                                                        .get_or_create(id=1)
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE dhcp_change SET seq = numbered.seq
+                    FROM (SELECT id, %s + row_number() OVER (ORDER BY id) AS seq
+                          FROM dhcp_change WHERE seq IS NULL) AS numbered
+                    WHERE dhcp_change.id = numbered.id""", [counter.counter])
+                counter.counter += cursor.rowcount
+            counter.save(update_fields=['counter'])
+        return counter.counter
+
+    @classmethod
+    def get_oldest_seq(cls):
+        """Return the oldest sequence number still kept. Changes after an
+        older one might have been pruned."""
+        oldest = cls.objects.aggregate(Min('seq'))['seq__min']
+        if oldest is None:
+            return DhcpChangeCounter.get_value() + 1
+        return oldest
+
+    @classmethod
+    def prune(cls, cutoff):
+        """Delete the numbered changes up to the newest one older than
+        cutoff, and return the number of deleted changes. The sequence
+        numbers kept are contiguous."""
+        last = cls.objects.filter(timestamp__lt=cutoff).aggregate(Max('seq'))['seq__max']
+        if last is None:
+            return 0
+        deleted, _ = cls.objects.filter(seq__lte=last).delete()
+        return deleted
@@ -0,0 +1,239 @@
+"""
+Publishing of zonefiles.
+
+Zonefiles are rendered by publish_zones(), run periodically by the
+publish_zones management command. It updates the serial numbers of all the
+updated zones in one query per zone type, and renders each zone which has
+changed since it was last published into the cache given by ZONEFILE_CACHE,
+as the current zonefile of the zone name. GET /zonefiles/<name> only reads
+the current zonefile, without using the database, and never updates serial
+numbers: changes are served when publish_zones has run. Only when a zone has
+not been published, or was evicted from the cache, is the zone read and
+rendered on request, with its current serial number. Zones which have been
+deleted are removed by the next publish_zones run.
+
+The cache must be a CACHES backend shared between the processes, e.g.
+memcached, for the web server to see the zonefiles. The default LocMemCache
+is per process, so with it every worker renders each zonefile itself.
+
+If ZONEFILE_ARTIFACT_DIR is set, the zonefiles are instead written to that
+directory, as ZONEFILE_ARTIFACT_DIR/<zone>/<serial>-<sha256>.zone, and the
+latest version is recorded in ZONEFILE_ARTIFACT_DIR/<zone>/current. Both are
+written to a temporary file and renamed into place, so readers never see a
+partial file. Requests for a published zone are answered from the file. The
+ZONEFILE_ARTIFACT_KEEP latest versions of each zone are kept.
+
+With more than one worker, given by ZONEFILE_RENDER_WORKERS or the workers
+argument, the zones are rendered concurrently by a pool of forked processes,
+each with its own database connection, and published by the parent process.
+"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+from mreg.api.v1.zonefile import ZoneFile
+from mreg.metrics import ZONEFILE_RENDER_DURATION
+from mreg.models import ForwardZone, ReverseZone
+
+logger = logging.getLogger(__name__)
+
+ZONE_MODELS = (ForwardZone, ReverseZone)
+
+
+def _get_cache():
+    return caches[getattr(settings, 'ZONEFILE_CACHE', 'default')]
+
+
+def get_cache_key(zone):
+    """Return the key of the version of the zonefile. It changes whenever
+    the zone or its serial number is updated."""
+    return 'zonefile:{}:{}:{}:{}'.format(zone._meta.model_name, zone.id,
+                                         zone.serialno, zone.updated_at.timestamp())
+
+
+def _get_current_key(name):
+    # The name comes from the URL, and might not be a valid cache key
+    return 'zonefile:current:' + hashlib.sha256(name.encode()).hexdigest()
+
+
+def render_zone(zone):
+    zone, key, data, duration = _render(zone)
+    ZONEFILE_RENDER_DURATION.observe((zone.name,), duration)
+    return data
+
+
+def _cache_zonefile(zone, key, data):
+    entry = {'key': key, 'serialno': zone.serialno, 'data': data,
+             'sha256': hashlib.sha256(data.encode()).hexdigest()}
+    _get_cache().set(_get_current_key(zone.name), entry, None)
+    return entry
+
+
+def get_zonefile_entry(zone):
+    """Return the current zonefile for the zone from the cache, as a dict
+    with its key, serialno, data and sha256, rendering it if needed."""
+    key = get_cache_key(zone)
+    entry = _get_cache().get(_get_current_key(zone.name))
+    if entry is None or entry['key'] != key:
+        entry = _cache_zonefile(zone, key, render_zone(zone))
+    return entry
+
+
+def get_zonefile(zone):
+    """Return the zonefile for the zone, rendering it if needed."""
+    return get_zonefile_entry(zone)['data']
+
+
+def get_published(name):
+    """Return the latest published zonefile for the zone name, without
+    using the database, or None if not published. It is a dict with the
+    sha256 and either the path of the file or the data."""
+    artifact = get_artifact(name)
+    if artifact is not None:
+        return artifact
+    return _get_cache().get(_get_current_key(name))
+
+
+def _get_artifact_dir():
+    return getattr(settings, 'ZONEFILE_ARTIFACT_DIR', None)
+
+
+def _write_atomic(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def get_artifact(name):
+    """Return the metadata of the latest published zonefile for the zone,
+    with the path of the file, or None if not published."""
+    artifact_dir = _get_artifact_dir()
+    if artifact_dir is None or not name or '/' in name or name.startswith('.'):
+        return None
+    zone_dir = os.path.join(artifact_dir, name)
+    try:
+        with open(os.path.join(zone_dir, 'current')) as f:
+            artifact = json.load(f)
+    except (OSError, ValueError):
+        return None
+    artifact['path'] = os.path.join(zone_dir, artifact['file'])
+    return artifact
+
+
+def publish_artifact(zone, key, data):
+    """Write the zonefile as a new version, and make it the current one."""
+    data = data.encode()
+    sha256 = hashlib.sha256(data).hexdigest()
+    zone_dir = os.path.join(_get_artifact_dir(), zone.name)
+    os.makedirs(zone_dir, exist_ok=True)
+    filename = f'{zone.serialno}-{sha256}.zone'
+    _write_atomic(os.path.join(zone_dir, filename), data)
+    current = {'file': filename, 'key': key, 'serialno': zone.serialno,
+               'sha256': sha256}
+    _write_atomic(os.path.join(zone_dir, 'current'), json.dumps(current).encode())
+
+    keep = getattr(settings, 'ZONEFILE_ARTIFACT_KEEP', 5)
+    versions = [os.path.join(zone_dir, i) for i in os.listdir(zone_dir)
+                if i.endswith('.zone') and i != filename]
+    versions.sort(key=os.path.getmtime, reverse=True)
+    for path in versions[max(keep - 1, 0):]:
+        os.unlink(path)
+
+
+def _remove_deleted_zones(names):
+    """Remove published zonefiles for zones which no longer exist."""
+    cache = _get_cache()
+    old_names = cache.get('zonefile:names', set())
+    cache.delete_many([_get_current_key(name) for name in old_names - names])
+    cache.set('zonefile:names', names, None)
+    artifact_dir = _get_artifact_dir()
+    if artifact_dir is None or not os.path.isdir(artifact_dir):
+        return
+    for name in os.listdir(artifact_dir):
+        if name not in names and not name.startswith('.'):
+            shutil.rmtree(os.path.join(artifact_dir, name), ignore_errors=True)
+
+
+def _render(zone):
+    start = time.perf_counter()
+    data = ZoneFile(zone).generate()
+    return zone, get_cache_key(zone), data, time.perf_counter() - start
+
+
+def _init_worker():
+    # Do not use the parent's connections, each worker opens its own.
+    connections.close_all()
+
+
+def _render_in_worker(args):
+    model, zone_id = args
+    try:
+        zone = model.objects.get(id=zone_id)
+    except model.DoesNotExist:
+        return None
+    return _render(zone)
+
+
+def _render_zones(zones, workers):
+    """Yield a tuple of zone, cache key, zonefile and render time for each
+    of the zones, rendered by up to workers processes. The render time is
+    returned, as metrics recorded in a worker are lost with it."""
+    workers = min(workers, len(zones))
+    if workers <= 1:
+        yield from map(_render, zones)
+        return
+    # Forked workers must not inherit open connections.
+    connections.close_all()
+    with multiprocessing.get_context('fork').Pool(workers, initializer=_init_worker) as pool:
+        todo = [(type(zone), zone.id) for zone in zones]
+        for result in pool.imap_unordered(_render_in_worker, todo):
+            if result is not None:
+                yield result
+
+
+def publish_zones(workers=None):
+    """Update the serial numbers of the updated zones, and render all zones
+    which are not yet published with their current serial number. Returns
+    the number of rendered zones."""
+    if workers is None:
+        workers = getattr(settings, 'ZONEFILE_RENDER_WORKERS', 1)
+    zones = dict()
+    for model in ZONE_MODELS:
+        model.update_serialnos()
+        zones.update((get_cache_key(zone), zone) for zone in model.objects.all())
+    use_artifacts = _get_artifact_dir() is not None
+    _remove_deleted_zones({zone.name for zone in zones.values()})
+    if use_artifacts:
+        current = {zone.name: get_artifact(zone.name) for zone in zones.values()}
+    else:
+        keys = {_get_current_key(zone.name): zone.name for zone in zones.values()}
+        current = {keys[key]: entry for key, entry in _get_cache().get_many(list(keys)).items()}
+    todo = [zone for key, zone in zones.items()
+            if (current.get(zone.name) or {}).get('key') != key]
+    rendered = 0
+    for zone, key, data, duration in _render_zones(todo, workers):
+        ZONEFILE_RENDER_DURATION.observe((zone.name,), duration)
+        if use_artifacts:
+            publish_artifact(zone, key, data)
+        else:
+            _cache_zonefile(zone, key, data)
+        logger.info("Published zone %s with serial %s", zone.name, zone.serialno)
+        rendered += 1
+    return rendered
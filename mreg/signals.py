@@ -1,108 +1,164 @@
-import functools
 import re
 
 from django.conf import settings
-from django.contrib.auth.models import Group
-from django.db.models.signals import post_delete, pre_delete , post_save, pre_save
+from django.contrib.auth.models import Group, User
+from django.db import IntegrityError, transaction
+from django.db.models.signals import (m2m_changed, post_delete, pre_delete,
+        post_save, pre_save)
 from django.dispatch import receiver
-from django.utils import timezone
 from django_auth_ldap.backend import populate_user
 
-from mreg.api.v1.serializers import HostSerializer
-from mreg.models import (Cname, ForwardZoneMember, Host, Ipaddress,
-        ModelChangeLog, Mx, Naptr, NameServer, PtrOverride, ReverseZone, Srv,
-        Txt)
+from mreg.api.permissions import invalidate_user_groups
+from mreg.authentication import invalidate_token_cache
+from mreg.batch import add_updated_zones, in_bulk_operation
+from mreg.history import add_host_history, get_host_history_data
+from mreg.models import (Cname, DhcpChange, ForwardZoneMember, Host,
+        Ipaddress, Mx, Naptr, NameServer, PtrOverride, ReverseZone, Srv, Txt)
+from rest_framework.authtoken.models import Token
 from rest_framework.exceptions import PermissionDenied
 
 
 @receiver(populate_user)
 def populate_user_from_ldap(sender, signal, user=None, ldap_user=None, **kwargs):
     """Find all groups from ldap with attr LDAP_GROUP_ATTR and matching
-    the regular expression LDAP_GROUP_RE. Will wipe previous group memberships
-    before adding new."""
+    the regular expression LDAP_GROUP_RE. The user's group memberships are
+    changed to match, only adding and removing the groups which differ."""
     LDAP_GROUP_ATTR = getattr(settings, 'LDAP_GROUP_ATTR', None)
     LDAP_GROUP_RE = getattr(settings, 'LDAP_GROUP_RE', None)
     if LDAP_GROUP_ATTR is None or LDAP_GROUP_RE is None:
         return
     user.save()
-    user.groups.clear()
     ldap_groups = ldap_user.attrs.get(LDAP_GROUP_ATTR, [])
     group_re = re.compile(LDAP_GROUP_RE)
+    wanted = set()
     for group_str in ldap_groups:
         res = group_re.match(group_str)
         if res:
-            group_name = res.group('group_name')
-            group, created = Group.objects.get_or_create(name=group_name)
-            group.user_set.add(user)
-            group.save()
+            wanted.add(res.group('group_name'))
+
+    current = set(user.groups.values_list('name', flat=True))
+    remove = current - wanted
+    add = wanted - current
+    if remove:
+        user.groups.remove(*user.groups.filter(name__in=remove))
+    if add:
+        missing = add - set(Group.objects.filter(name__in=add).values_list('name', flat=True))
+        if missing:
+            try:
+                with transaction.atomic():
+                    Group.objects.bulk_create(Group(name=i) for i in sorted(missing))
+            except IntegrityError:
+                # Some were created by a concurrent login, so create the
+                # rest one by one.
+                for name in sorted(missing):
+                    Group.objects.get_or_create(name=name)
+        user.groups.add(*Group.objects.filter(name__in=add))
+    if remove or add:
+        invalidate_user_groups([user.id])
+
+
+# Remove cached tokens when they are refreshed or deleted, or the user is
+# changed, see mreg.authentication.
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def invalidate_cached_token(sender, instance, **kwargs):
+    invalidate_token_cache(instance.key)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user_tokens(sender, instance, **kwargs):
+    for key in Token.objects.filter(user=instance.id).values_list('key', flat=True):
+        invalidate_token_cache(key)
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_cached_user_groups(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # The members of the group are gone after it has been cleared
+        instance._cleared_user_ids = list(instance.user_set.values_list('id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        invalidate_user_groups([instance.id])
+    elif action == 'post_clear':
+        invalidate_user_groups(instance.__dict__.pop('_cleared_user_ids', ()))
+    elif pk_set:
+        invalidate_user_groups(pk_set)
+
+
+# The memberships of a deleted group are removed without m2m_changed.
+@receiver(pre_delete, sender=Group)
+def save_deleted_group_members(sender, instance, **kwargs):
+    instance._deleted_user_ids = list(instance.user_set.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Group)
+def invalidate_deleted_group_members(sender, instance, **kwargs):
+    invalidate_user_groups(instance.__dict__.pop('_deleted_user_ids', ()))
+
 
 def _del_ptr(ipaddress):
-    ptrs = PtrOverride.objects.filter(ipaddress=ipaddress)
-    if ptrs:
-        assert(ptrs.count() == 1)
-        ptrs.delete()
+    PtrOverride.objects.filter(ipaddress=ipaddress).delete()
 
 # Update PtrOverride whenever a Ipaddress is created or changed
 @receiver(pre_save, sender=Ipaddress)
 def updated_ipaddress_fix_ptroverride(sender, instance, raw, using, update_fields, **kwargs):
+    if in_bulk_operation():
+        return
     if instance.id:
-        oldinstance = Ipaddress.objects.get(id=instance.id)
-        _del_ptr(oldinstance.ipaddress)
+        oldips = Ipaddress.objects.filter(id=instance.id).values('ipaddress')
+        PtrOverride.objects.filter(ipaddress__in=oldips).delete()
     else:
         # Can only add a PtrOverride if count == 1, otherwise we can not guess which
         # one should get it.
-        if Ipaddress.objects.filter(ipaddress=instance.ipaddress).count() == 1:
-            host = Ipaddress.objects.get(ipaddress=instance.ipaddress).host
-            ptr = PtrOverride.objects.create(host=host, ipaddress=instance.ipaddress)
-            ptr.save()
+        hosts = Ipaddress.objects.filter(ipaddress=instance.ipaddress).values_list('host', flat=True)
+        hosts = list(hosts[:2])
+        if len(hosts) == 1:
+            PtrOverride.objects.create(host_id=hosts[0], ipaddress=instance.ipaddress)
 
 # Remove old PtrOverride, if possible, when an Ipaddress is deleted.
 @receiver(post_delete, sender=Ipaddress)
 def deleted_ipaddress_fix_ptroverride(sender, instance, using, **kwargs):
+    if in_bulk_operation():
+        return
     _del_ptr(instance.ipaddress)
 
 
 def _common_update_zone(signal, sender, instance):
-
-    @functools.lru_cache()
-    def _get_zone_for_ip(ip):
-        return ReverseZone.get_zone_by_ip(ip)
-
-    zones = set()
+    forward_ids = set()
+    ips = set()
 
     if isinstance(instance, ForwardZoneMember):
-        zones.add(instance.zone)
+        forward_ids.add(instance.zone_id)
         if signal == "pre_save" and instance.id:
-            oldzone = sender.objects.get(id=instance.id).zone
-            zones.add(oldzone)
+            oldzone = sender.objects.filter(id=instance.id).values_list('zone', flat=True)
+            forward_ids.update(oldzone)
 
-    if hasattr(instance, 'host'):
-        zones.add(instance.host.zone)
-        if signal == "pre_save" and instance.host.id:
-            oldzone = Host.objects.get(id=instance.host.id).zone
-            zones.add(oldzone)
+    if sender in (Cname, Ipaddress, Mx, Naptr, PtrOverride, Txt):
+        hostzone = Host.objects.filter(id=instance.host_id).values_list('zone', flat=True)
+        forward_ids.update(hostzone)
 
     if sender in (Ipaddress, PtrOverride):
-        zone = _get_zone_for_ip(instance.ipaddress)
-        zones.add(zone)
+        ips.add(instance.ipaddress)
 
     # Check if host has been renamed, and if so, update other zones
     # where the host is used. Such as reverse zones, Cname targets etc.
     if signal == "pre_save" and sender == Host and instance.id:
-        oldname = Host.objects.get(id=instance.id).name
+        oldname = Host.objects.filter(id=instance.id).values_list('name', flat=True).first()
         if instance.name != oldname:
             # XXX: add SRV in after usit-gd/mreg#192
             for model in (Cname,):
-                for i in model.objects.filter(host=instance):
-                    zones.add(i.zone)
+                forward_ids.update(model.objects.filter(host=instance)
+                                                .values_list('zone', flat=True))
             for model in (Ipaddress, PtrOverride):
-                for i in model.objects.filter(host=instance):
-                    zones.add(_get_zone_for_ip(i.ipaddress))
+                ips.update(model.objects.filter(host=instance)
+                                        .values_list('ipaddress', flat=True))
 
-    for zone in zones:
-        if zone:
-            zone.updated = True
-            zone.save()
+    reverse_ids = set()
+    if ips:
+        reverse_ids.update(ReverseZone.get_zones_by_ips(ips).values_list('id', flat=True))
+    add_updated_zones(forward_ids, reverse_ids)
 
 @receiver(pre_save, sender=Cname)
 @receiver(pre_save, sender=Ipaddress)
@@ -113,6 +169,8 @@ def _common_update_zone(signal, sender, instance):
 @receiver(pre_save, sender=Srv)
 @receiver(pre_save, sender=Txt)
 def updated_objects_update_zone_serial(sender, instance, raw, using, update_fields, **kwargs):
+    if in_bulk_operation():
+        return
     _common_update_zone("pre_save", sender, instance)
 
 
@@ -126,6 +184,8 @@ def updated_objects_update_zone_serial(sender, instance, raw, using, update_fiel
 @receiver(post_delete, sender=Srv)
 @receiver(post_delete, sender=Txt)
 def deleted_objects_update_zone_serial(sender, instance, using, **kwargs):
+    if in_bulk_operation():
+        return
     _common_update_zone("post_delete", sender, instance)
 
 # To log host history, an approach using post_save signals for related objects was chosen.
@@ -135,7 +195,8 @@ def deleted_objects_update_zone_serial(sender, instance, using, **kwargs):
 # Additionally, the Hosts object is saved before the related objects when creating a new host,
 # so ipaddress data isn't available at the time of post_save for the Hosts object.
 #
-# Currently saves a JSON-snapshot of all data for the host.
+# Currently saves a JSON-snapshot of all data for the host. The snapshots are
+# coalesced to one per host per transaction, see mreg.history.
 # TODO: Deleting a host should probably do something. Export/delete log for that host after some time?
 
 
@@ -146,19 +207,9 @@ def deleted_objects_update_zone_serial(sender, instance, using, **kwargs):
 @receiver(post_save, sender=Naptr)
 def save_host_history_on_save(sender, instance, created, **kwargs):
     """Receives post_save signal for models that have a ForeignKey to Hosts and updates the host history log."""
-    hostdata = HostSerializer(Host.objects.get(pk=instance.host_id)).data
-
-    # Cleaning up data from related tables
-    hostdata['ipaddresses'] = [record['ipaddress'] for record in hostdata['ipaddresses']]
-    hostdata['txts'] = [record['txt'] for record in hostdata['txts']]
-    hostdata['cnames'] = [record['name'] for record in hostdata['cnames']]
-    hostdata['ptr_overrides'] = [record['ipaddress'] for record in hostdata['ptr_overrides']]
-    new_log_entry = ModelChangeLog(table_name='host',
-                                   table_row=hostdata['id'],
-                                   data=hostdata,
-                                   action='saved',
-                                   timestamp=timezone.now())
-    new_log_entry.save()
+    if in_bulk_operation():
+        return
+    add_host_history(instance.host_id, 'saved')
 
 
 @receiver(post_delete, sender=PtrOverride)
@@ -168,20 +219,9 @@ def save_host_history_on_save(sender, instance, created, **kwargs):
 @receiver(post_delete, sender=Naptr)
 def save_host_history_on_delete(sender, instance, **kwargs):
     """Receives post_delete signal for models that have a ForeignKey to Hosts and updates the host history log."""
-    hostdata = HostSerializer(Host.objects.get(pk=instance.host_id)).data
-
-    # Cleaning up data from related tables
-    hostdata['ipaddresses'] = [record['ipaddress'] for record in hostdata['ipaddresses']]
-    hostdata['txts'] = [record['txt'] for record in hostdata['txts']]
-    hostdata['cnames'] = [record['name'] for record in hostdata['cnames']]
-    hostdata['ptr_overrides'] = [record['ipaddress'] for record in hostdata['ptr_overrides']]
-
-    new_log_entry = ModelChangeLog(table_name='host',
-                                   table_row=hostdata['id'],
-                                   data=hostdata,
-                                   action='deleted',
-                                   timestamp=timezone.now())
-    new_log_entry.save()
+    if in_bulk_operation():
+        return
+    add_host_history(instance.host_id, 'deleted')
 
 
 @receiver(pre_delete, sender=Ipaddress)
@@ -191,21 +231,90 @@ def prevent_nameserver_deletion(sender, instance, using, **kwargs):
     Receives pre_delete signal for Host and Ipaddress-models that are about to be deleted.
     It then checks if the object about to be deleted belongs to a nameserver, and then prevents the deletion.
     """
+    if in_bulk_operation():
+        return
+    # Most hosts are not nameservers, so check that first with one query.
     if isinstance(instance, Host):
-        name = instance.name
+        names = [instance.name]
     elif isinstance(instance, Ipaddress):
-        name = instance.host.name
-        if instance.host.ipaddresses.count() > 1:
+        names = Host.objects.filter(id=instance.host_id).values('name')
+    if not NameServer.get_in_use(names).exists():
+        return
+    if isinstance(instance, Ipaddress):
+        if Ipaddress.objects.filter(host=instance.host_id).count() > 1:
             return
 
-    nameserver = NameServer.objects.filter(name=name).first()
+    raise PermissionDenied(detail='This host is a nameserver and cannot be deleted until' \
+                            'it has been removed from all zones its setup as a nameserver')
 
-    if nameserver:
-        usedcount = 0
-        for i in ('forwardzone', 'reversezone', 'forwardzonedelegation',
-                  'reversezonedelegation'):
-            usedcount += getattr(nameserver, f"{i}_set").count()
 
-        if usedcount >= 1:
-            raise PermissionDenied(detail='This host is a nameserver and cannot be deleted until' \
-                                    'it has been removed from all zones its setup as a nameserver')
+@receiver(pre_delete, sender=Host)
+def save_host_history_on_host_delete(sender, instance, **kwargs):
+    """Receives pre_delete signal for Hosts. The history is written when the
+    transaction commits, and the host is gone by then, so take its snapshot
+    now. Must be connected after prevent_nameserver_deletion."""
+    if in_bulk_operation():
+        return
+    add_host_history(instance.id, 'deleted', data=get_host_history_data(instance))
+
+
+# Changes to the data exported to the DHCP servers, Ipaddress rows with a
+# MAC address and the names of their hosts, are logged as DhcpChange, and
+# numbered when read, see DhcpChange.number_changes(). A changed reservation
+# is logged as the old one deleted and the new saved.
+@receiver(pre_save, sender=Ipaddress)
+def ipaddress_get_dhcp_data(sender, instance, raw, using, update_fields, **kwargs):
+    if in_bulk_operation():
+        return
+    instance._dhcp_old = None
+    if instance.id:
+        old = Ipaddress.objects.filter(id=instance.id)
+        instance._dhcp_old = old.values_list('host__name', 'ipaddress', 'macaddress').first()
+
+
+@receiver(post_save, sender=Ipaddress)
+def ipaddress_log_dhcp_change(sender, instance, **kwargs):
+    if in_bulk_operation():
+        return
+    old = getattr(instance, '_dhcp_old', None)
+    instance._dhcp_old = None
+    new = None
+    if instance.macaddress:
+        new = (instance.host.name, instance.ipaddress, instance.macaddress)
+    if new == old:
+        return
+    changes = []
+    if old is not None and old[2]:
+        changes.append(('deleted',) + old)
+    if new is not None:
+        changes.append(('saved',) + new)
+    DhcpChange.log(changes)
+
+
+@receiver(post_delete, sender=Ipaddress)
+def ipaddress_log_dhcp_delete(sender, instance, **kwargs):
+    if in_bulk_operation() or not instance.macaddress:
+        return
+    hostname = Host.objects.filter(id=instance.host_id).values_list('name', flat=True).first()
+    DhcpChange.log([('deleted', hostname, instance.ipaddress, instance.macaddress)])
+
+
+@receiver(pre_save, sender=Host)
+def host_get_dhcp_data(sender, instance, raw, using, update_fields, **kwargs):
+    if in_bulk_operation() or not instance.id:
+        return
+    # Only found if the host is renamed
+    ips = Ipaddress.objects.filter(host=instance.id).exclude(macaddress='')
+    ips = ips.exclude(host__name=instance.name)
+    instance._dhcp_old = list(ips.values_list('host__name', 'ipaddress', 'macaddress'))
+
+
+@receiver(post_save, sender=Host)
+def host_log_dhcp_change(sender, instance, **kwargs):
+    old = getattr(instance, '_dhcp_old', None)
+    if not old:
+        return
+    instance._dhcp_old = None
+    changes = [('deleted',) + i for i in old]
+    changes.extend(('saved', instance.name, ip, mac) for name, ip, mac in old)
+    DhcpChange.log(changes)
@@ -1,7 +1,25 @@
+import ast
+import io
+import tempfile
+
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import Group, User
+from django.core.cache import caches
 from django.core.exceptions import ValidationError
-from django.test import TestCase
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
 
-from mreg.models import (ForwardZone, Host, Ipaddress, NameServer, Network, ReverseZone)
+from mreg.history import get_history, prune_history
+from mreg.metrics import ZONEFILE_RENDER_DURATION
+from mreg.models import (ForwardZone, Host, Ipaddress, ModelChangeLog, NameServer,
+                         Network, ReverseZone, Txt)
+from mreg.publish import get_artifact, get_zonefile, publish_zones, render_zone
+from mreg.signals import populate_user_from_ldap
+from mreg.utils import idna_encode, isascii, qualify
+from mreg.validators import validate_hostname
 from rest_framework.exceptions import PermissionDenied
 
 
@@ -118,3 +136,362 @@ class NameServerDeletionTestCase(TestCase):
         self.ns_hostip2.delete()
         new_count = Ipaddress.objects.count()
         self.assertNotEqual(old_count, new_count)
+
+    def test_model_nameserver_usedcount(self):
+        """Test that usedcount counts both zones and delegations, and that an
+        unused nameserver is removed with the last zone using it."""
+        self.zone_1010.nameservers.add(self.ns_sample)
+        ns = NameServer.with_usedcount().get(name='ns.example.org')
+        self.assertEqual(ns.usedcount, 2)
+        self.zone_sample.update_nameservers([])
+        self.assertTrue(NameServer.objects.filter(name='ns.example.org').exists())
+        self.zone_1010.update_nameservers([])
+        self.assertFalse(NameServer.objects.filter(name='ns.example.org').exists())
+
+    def test_model_update_nameservers(self):
+        """Test that update_nameservers reuses existing nameservers, creates
+        the missing ones and keeps nameservers used elsewhere."""
+        self.zone_1010.update_nameservers(['ns.example.org', 'ns2.example.org'])
+        self.assertEqual(NameServer.objects.filter(name='ns.example.org').count(), 1)
+        self.zone_sample.update_nameservers(['ns2.example.org', 'ns3.example.org'])
+        names = self.zone_sample.nameservers.values_list('name', flat=True)
+        self.assertEqual(sorted(names), ['ns2.example.org', 'ns3.example.org'])
+        self.assertEqual(NameServer.objects.count(), 3)
+
+
+class ZoneUpdateBatchTestCase(TransactionTestCase):
+    """This class tests the deferred marking of updated zones."""
+
+    def setUp(self):
+        self.zone_sample = ForwardZone(name='example.org',
+                                       primary_ns='ns.example.org',
+                                       email='hostmaster@example.org')
+        clean_and_save(self.zone_sample)
+        self.zone_1010 = ReverseZone(name='10.10.in-addr.arpa',
+                                     primary_ns='ns.example.org',
+                                     email='hostmaster@example.org')
+        clean_and_save(self.zone_1010)
+        self.host = Host(name='host.example.org',
+                         contact='mail@example.org',
+                         zone=self.zone_sample)
+        clean_and_save(self.host)
+        for zone in (self.zone_sample, self.zone_1010):
+            zone.updated = False
+            zone.save()
+
+    def test_zones_marked_on_commit(self):
+        """Zones should only be marked as updated when the transaction
+        commits"""
+        with transaction.atomic():
+            clean_and_save(Ipaddress(host=self.host, ipaddress='10.10.0.1'))
+            clean_and_save(Ipaddress(host=self.host, ipaddress='10.10.0.2'))
+            self.zone_1010.refresh_from_db()
+            self.assertFalse(self.zone_1010.updated)
+        self.zone_sample.refresh_from_db()
+        self.zone_1010.refresh_from_db()
+        self.assertTrue(self.zone_sample.updated)
+        self.assertTrue(self.zone_1010.updated)
+
+    def test_zones_not_marked_on_rollback(self):
+        """Zones should not be marked as updated by a rolled back
+        transaction, nor by the next one"""
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                clean_and_save(Ipaddress(host=self.host, ipaddress='10.10.0.1'))
+                raise ValueError
+        with transaction.atomic():
+            clean_and_save(Txt(host=self.host, txt='some text'))
+        self.zone_sample.refresh_from_db()
+        self.zone_1010.refresh_from_db()
+        self.assertTrue(self.zone_sample.updated)
+        self.assertFalse(self.zone_1010.updated)
+
+    def test_zones_marked_without_transaction(self):
+        """In autocommit mode the zones should be marked at once"""
+        clean_and_save(Ipaddress(host=self.host, ipaddress='10.10.0.1'))
+        self.zone_1010.refresh_from_db()
+        self.assertTrue(self.zone_1010.updated)
+
+
+class HostHistoryBatchTestCase(TransactionTestCase):
+    """This class tests the coalescing of host history entries."""
+
+    def setUp(self):
+        self.host = Host(name='host.example.org',
+                         contact='mail@example.org')
+        clean_and_save(self.host)
+
+    def _get_logs(self):
+        return ModelChangeLog.objects.filter(table_name='host',
+                                             table_row=self.host.id)
+
+    def test_one_entry_per_host_in_transaction(self):
+        """Multiple changes to a host in a transaction should give one entry,
+        written when it commits"""
+        with transaction.atomic():
+            clean_and_save(Ipaddress(host=self.host, ipaddress='10.0.0.1'))
+            clean_and_save(Ipaddress(host=self.host, ipaddress='10.0.0.2'))
+            clean_and_save(Txt(host=self.host, txt='some text'))
+            self.assertEqual(self._get_logs().count(), 0)
+        self.assertEqual(self._get_logs().count(), 1)
+        self.assertEqual(self._get_logs().get().action, 'saved')
+
+    def test_no_entry_on_rollback(self):
+        """A rolled back transaction should not be logged"""
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                clean_and_save(Ipaddress(host=self.host, ipaddress='10.0.0.1'))
+                raise ValueError
+        self.assertEqual(self._get_logs().count(), 0)
+
+    def test_deleted_host(self):
+        """Deleting a host should log its snapshot as deleted"""
+        clean_and_save(Ipaddress(host=self.host, ipaddress='10.0.0.1'))
+        old_count = self._get_logs().count()
+        host_id = self.host.id
+        self.host.delete()
+        logs = ModelChangeLog.objects.filter(table_row=host_id)
+        self.assertEqual(logs.count(), old_count + 1)
+        self.assertEqual(logs.order_by('id').last().action, 'deleted')
+
+
+class HostHistoryDeltaTestCase(TransactionTestCase):
+    """This class tests the delta encoding of the host history."""
+
+    def setUp(self):
+        self.host = Host(name='host.example.org',
+                         contact='mail@example.org')
+        clean_and_save(self.host)
+
+    @override_settings(HOST_HISTORY_SNAPSHOT_INTERVAL=3)
+    def test_deltas_and_snapshots(self):
+        """Only every HOST_HISTORY_SNAPSHOT_INTERVAL entry should be a full
+        snapshot, and the history should still give full data"""
+        for i in range(1, 6):
+            clean_and_save(Ipaddress(host=self.host, ipaddress=f'10.0.0.{i}'))
+        logs = ModelChangeLog.objects.filter(table_name='host', table_row=self.host.id)
+        self.assertEqual([i.delta for i in logs.order_by('id')],
+                         [False, True, True, False, True])
+        history = get_history('host', self.host.id)
+        self.assertEqual(len(history), 5)
+        for i, entry in enumerate(history, 1):
+            data = ast.literal_eval(entry['data'])
+            self.assertEqual(data['name'], self.host.name)
+            self.assertEqual(len(data['ipaddresses']), i)
+            self.assertNotIn('delta', entry)
+
+    def test_history_with_old_entries(self):
+        """Entries from before the JSON format should be returned as they
+        are, and the data of all entries as strings"""
+        old_data = str({'id': self.host.id, 'name': self.host.name})
+        ModelChangeLog.objects.create(table_name='host', table_row=self.host.id,
+                                      data=old_data, action='saved',
+                                      timestamp=timezone.now() - timedelta(days=1))
+        clean_and_save(Ipaddress(host=self.host, ipaddress='10.0.0.1'))
+        clean_and_save(Ipaddress(host=self.host, ipaddress='10.0.0.2'))
+        history = get_history('host', self.host.id)
+        self.assertEqual(history[0]['data'], old_data)
+        for entry in history:
+            self.assertIsInstance(entry['data'], str)
+        self.assertEqual(ast.literal_eval(history[-1]['data'])['ipaddresses'],
+                         ['10.0.0.1', '10.0.0.2'])
+
+    @override_settings(HOST_HISTORY_SNAPSHOT_INTERVAL=3)
+    def test_prune_history(self):
+        """Pruning should remove the old entries, and keep the remaining
+        history readable"""
+        for i in range(1, 6):
+            clean_and_save(Ipaddress(host=self.host, ipaddress=f'10.0.0.{i}'))
+        logs = ModelChangeLog.objects.filter(table_name='host', table_row=self.host.id)
+        ids = list(logs.order_by('id').values_list('id', flat=True))
+        old = timezone.now() - timedelta(days=30)
+        logs.filter(id__in=ids[:2]).update(timestamp=old)
+        archive = io.StringIO()
+        deleted = prune_history(old + timedelta(days=1), archive=archive, batch_size=1)
+        self.assertEqual(deleted, 2)
+        self.assertEqual(len(archive.getvalue().splitlines()), 2)
+        self.assertFalse(logs.get(id=ids[2]).delta)
+        history = get_history('host', self.host.id)
+        self.assertEqual([len(ast.literal_eval(i['data'])['ipaddresses']) for i in history],
+                         [3, 4, 5])
+
+    @override_settings(HOST_HISTORY_SNAPSHOT_INTERVAL=3)
+    def test_prune_history_by_timestamp(self):
+        """Entries should be pruned by timestamp, not id, and the newest
+        entry of a row kept"""
+        for i in range(1, 5):
+            clean_and_save(Ipaddress(host=self.host, ipaddress=f'10.0.0.{i}'))
+        logs = ModelChangeLog.objects.filter(table_name='host', table_row=self.host.id)
+        ids = list(logs.order_by('id').values_list('id', flat=True))
+        old = timezone.now() - timedelta(days=30)
+        logs.filter(id__in=[ids[0], ids[2], ids[3]]).update(timestamp=old)
+        self.assertEqual(prune_history(old + timedelta(days=1)), 2)
+        self.assertEqual(sorted(logs.values_list('id', flat=True)), [ids[1], ids[3]])
+        history = get_history('host', self.host.id)
+        self.assertEqual([len(ast.literal_eval(i['data'])['ipaddresses']) for i in history],
+                         [4, 2])
+
+    def test_prune_history_archive_failure(self):
+        """Nothing should be deleted if the archive can not be written"""
+        clean_and_save(Ipaddress(host=self.host, ipaddress='10.0.0.1'))
+        clean_and_save(Ipaddress(host=self.host, ipaddress='10.0.0.2'))
+        logs = ModelChangeLog.objects.filter(table_name='host', table_row=self.host.id)
+        logs.update(timestamp=timezone.now() - timedelta(days=30))
+
+        class FullArchive(io.StringIO):
+            def write(self, s):
+                raise OSError('No space left on device')
+
+        with self.assertRaises(OSError):
+            prune_history(timezone.now(), archive=FullArchive())
+        self.assertEqual(logs.count(), 2)
+
+
+class ZonePublishTestCase(TransactionTestCase):
+    """This class tests the batched serial number updates and publishing of
+    zonefiles."""
+
+    def setUp(self):
+        self.zone_sample = ForwardZone(name='example.org',
+                                       primary_ns='ns.example.org',
+                                       email='hostmaster@example.org')
+        clean_and_save(self.zone_sample)
+        self.zone_recent = ForwardZone(name='example.net',
+                                       primary_ns='ns.example.net',
+                                       email='hostmaster@example.net')
+        clean_and_save(self.zone_recent)
+        old = timezone.now() - timedelta(minutes=5)
+        ForwardZone.objects.filter(id=self.zone_sample.id).update(serialno_updated_at=old)
+        caches['default'].clear()
+
+    def test_update_serialnos(self):
+        """Only zones with a serial number older than a minute should be
+        updated"""
+        self.assertEqual(ForwardZone.update_serialnos(), 1)
+        zone = ForwardZone.objects.get(id=self.zone_sample.id)
+        self.assertFalse(zone.updated)
+        self.assertGreater(zone.serialno, self.zone_sample.serialno)
+        zone = ForwardZone.objects.get(id=self.zone_recent.id)
+        self.assertTrue(zone.updated)
+        self.assertEqual(zone.serialno, self.zone_recent.serialno)
+
+    def test_publish_zones(self):
+        """Zones should only be rendered when changed"""
+        self.assertEqual(publish_zones(), 2)
+        self.assertEqual(publish_zones(), 0)
+        zone = ForwardZone.objects.get(id=self.zone_sample.id)
+        self.assertIn(str(zone.serialno), get_zonefile(zone))
+        clean_and_save(Host(name='host.example.org', contact='mail@example.org',
+                            zone=self.zone_sample))
+        self.assertEqual(publish_zones(), 1)
+
+    def test_publish_zones_workers(self):
+        """Zones rendered by several workers should be the same as when
+        rendered serially, with the render time recorded"""
+        self.assertEqual(publish_zones(workers=1), 2)
+        zones = list(ForwardZone.objects.all())
+        serial = [get_zonefile(zone) for zone in zones]
+        caches['default'].clear()
+        labels = (self.zone_sample.name,)
+        count = ZONEFILE_RENDER_DURATION.values.get(labels, [0, 0])[-2]
+        self.assertEqual(publish_zones(workers=2), 2)
+        self.assertEqual(ZONEFILE_RENDER_DURATION.values[labels][-2], count + 1)
+        with mock.patch('mreg.publish.render_zone') as render:
+            self.assertEqual([get_zonefile(zone) for zone in zones], serial)
+            render.assert_not_called()
+
+    def test_publish_zones_artifacts(self):
+        """Zones should be published as files when ZONEFILE_ARTIFACT_DIR is
+        set, and removed when the zone is deleted"""
+        with tempfile.TemporaryDirectory() as artifact_dir, \
+                override_settings(ZONEFILE_ARTIFACT_DIR=artifact_dir):
+            self.assertEqual(publish_zones(), 2)
+            self.assertEqual(publish_zones(), 0)
+            zone = ForwardZone.objects.get(id=self.zone_sample.id)
+            artifact = get_artifact(zone.name)
+            self.assertEqual(artifact['serialno'], zone.serialno)
+            with open(artifact['path']) as f:
+                self.assertEqual(f.read(), render_zone(zone))
+            self.zone_recent.delete()
+            publish_zones()
+            self.assertIsNone(get_artifact('example.net'))
+
+
+class ZonefileUtilsTestCase(TestCase):
+    """This class tests the name helpers used by the zonefile export."""
+
+    def test_qualify(self):
+        self.assertEqual(qualify('host.example.org', 'example.org'), 'host')
+        self.assertEqual(qualify('a.b.example.org', 'example.org'), 'a.b')
+        self.assertEqual(qualify('example.org', 'example.org'), '')
+        self.assertEqual(qualify('host.example.com', 'example.org'), 'host.example.com.')
+        self.assertEqual(qualify('host.example.com.', 'example.org'), 'host.example.com.')
+        self.assertEqual(qualify('example.org', 'example.org', shortform=False), 'example.org.')
+
+    def test_idna_encode(self):
+        self.assertEqual(idna_encode('host.example.org'), 'host.example.org')
+        self.assertEqual(idna_encode('*.example.org'), '*.example.org')
+        self.assertEqual(idna_encode('blåbær.example.org'), 'xn--blbr-roah.example.org')
+        self.assertTrue(isascii('host.example.org'))
+        self.assertFalse(isascii('blåbær'))
+
+
+class ValidateHostnameTestCase(TestCase):
+    """This class tests validate_hostname."""
+
+    def test_valid_names(self):
+        for name in ('host.example.org', '*.example.org', 'blåbær.example.org'):
+            validate_hostname(name)
+            validate_hostname(name)
+
+    def test_invalid_names(self):
+        """Invalid names must fail every time, also when validated before"""
+        for name in ('host.example.org.', 'a_b.example.org', 'a*.example.org', 'nodot'):
+            for _ in range(2):
+                with self.assertRaises(ValidationError):
+                    validate_hostname(name)
+
+
+class LdapGroupSyncTestCase(TestCase):
+    """This class tests the group sync in populate_user_from_ldap."""
+
+    class LdapUser:
+        def __init__(self, *groups):
+            self.attrs = {'memberof': [f'cn={i},cn=netgroups,dc=example,dc=com'
+                                       for i in groups]}
+
+    def setUp(self):
+        self.user = User.objects.create(username='nobody')
+
+    def _groups(self):
+        return sorted(self.user.groups.values_list('name', flat=True))
+
+    @override_settings(LDAP_GROUP_ATTR='memberof',
+                       LDAP_GROUP_RE=r"""^cn=(?P<group_name>[\w\-]+),cn=netgroups,""")
+    def test_group_sync(self):
+        """Only the changed groups should be added and removed"""
+        populate_user_from_ldap(None, None, user=self.user,
+                                ldap_user=self.LdapUser('group1', 'group2'))
+        self.assertEqual(self._groups(), ['group1', 'group2'])
+        group2 = Group.objects.get(name='group2')
+        populate_user_from_ldap(None, None, user=self.user,
+                                ldap_user=self.LdapUser('group2', 'group3'))
+        self.assertEqual(self._groups(), ['group2', 'group3'])
+        self.assertEqual(Group.objects.get(name='group2').id, group2.id)
+        self.assertTrue(Group.objects.filter(name='group1').exists())
+
+    @override_settings(LDAP_GROUP_ATTR='memberof',
+                       LDAP_GROUP_RE=r"""^cn=(?P<group_name>[\w\-]+),cn=netgroups,""")
+    def test_group_sync_concurrent_create(self):
+        """All the groups should be added when one of them is created by a
+        concurrent login"""
+        bulk_create = Group.objects.bulk_create
+
+        def concurrent_bulk_create(groups):
+            Group.objects.create(name='group2')
+            return bulk_create(groups)
+
+        with mock.patch.object(Group.objects, 'bulk_create', concurrent_bulk_create):
+            populate_user_from_ldap(None, None, user=self.user,
+                                    ldap_user=self.LdapUser('group1', 'group2', 'group3'))
+        self.assertEqual(self._groups(), ['group1', 'group2', 'group3'])
@@ -1,6 +1,6 @@
+import functools
 import idna
 import ipaddress
-import re
 import time
 
 
@@ -26,26 +26,51 @@ def qualify(name, zone, shortform=True):
     :return: String with punctuation appended or unchanged
     """
     if name.endswith(zone) and shortform:
-        name = re.sub('(.?%s)$' % zone, '', name)
+        # Strip the zone and the dot before it
+        name = name[:max(len(name) - len(zone) - 1, 0)]
     elif not name.endswith("."):
         name += '.'
     return name
 
+if hasattr(str, 'isascii'):
+    isascii = str.isascii
+else:
+    def isascii(value):
+        """
+        Checks if the string is all ASCII, like str.isascii() in python 3.7
+        :param value: String to check
+        :return: True if all characters are ASCII
+        """
+        try:
+            value.encode('ascii')
+        except UnicodeEncodeError:
+            return False
+        return True
+
+
+@functools.lru_cache(maxsize=4096)
+def idna_encode_label(label):
+    """
+    Encodes a single label to IDNA. The result is cached, as the same
+    labels are encoded over and over again by the zonefile export.
+    :param label: Label to encode
+    :return: String encoded to IDNA and converted to utf-8
+    """
+    return idna.encode(label).decode('utf-8')
+
+
 def idna_encode(entry):
     """
     Encodes the entry to an IDNA entry.
     :param entry: Entry to encode
     :return: String encoded to IDNA and converted to utf-8
     """
-    res = []
+    if isascii(entry):
+        return entry
     # idna encode each label, and only those who needs it, as
     # e.g. the idna module doesn't like to encode "*".
-    for label in entry.split("."):
-        # convert to label.isascii() in python 3.7
-        if not all(ord(char) < 128 for char in label):
-            label = idna.encode(label).decode('utf-8')
-        res.append(label)
-    return ".".join(res)
+    return ".".join(label if isascii(label) else idna_encode_label(label)
+                    for label in entry.split("."))
 
 
 def encode_mail(mail):
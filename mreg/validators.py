@@ -1,4 +1,6 @@
+import functools
 import ipaddress
+import re
 
 import idna
 
@@ -6,7 +8,7 @@ from django.core.validators import RegexValidator, MinValueValidator, MaxValueVa
 from django.core.exceptions import ValidationError
 from rest_framework import serializers
 
-from .utils import get_network_from_zonename
+from .utils import get_network_from_zonename, idna_encode_label, isascii
 
 
 # TODO: Move some validators to client
@@ -31,14 +33,23 @@ def validate_ttl(value):
     if value > 68400:
         raise ValidationError("Ensure this value is less than or equal to 68400.")
 
+_LABEL_REGEX = re.compile(r"^([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])$")
+
+
 def validate_hostname(name):
     """ Validate a hostname. """
+    _validate_hostname(name)
+
 
+# Only valid names are cached, as lru_cache does not cache exceptions.
+@functools.lru_cache(maxsize=65536)
+def _validate_hostname(name):
     if name.endswith("."):
         raise ValidationError("Name must not end with a punctuation mark.")
     # Assume we are not running a tld
     if not "." in name:
         raise ValidationError("Name must include a tld.")
+    ascii_name = isascii(name)
     # Any label in can be max 63 characters, after idna encoding
     for label in name.split("."):
         if label == '':
@@ -47,21 +58,19 @@ def validate_hostname(name):
             raise ValidationError("Can not start or end a label with a hyphen '{}'".format(label))
         if len(label) > 63:
             raise ValidationError("Label '{}' is {} characters long, maximum is 63".format(label, len(label)))
-        # convert to .isascii in python 3.7
-        if all(ord(char) < 128 for char in label):
+        if ascii_name or isascii(label):
             if "*" in label:
                 if len(label) > 1:
                         raise ValidationError("Wildcard must be standalone")
                 else:
                     continue
-            label_regex = "^([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])$"
-            validator = RegexValidator(label_regex,
-                                       message="Label '{}' is not valid. "
-                                               "Must be within [a-zA-Z0-9-].".format(label))
-            validator(label)
+            if not _LABEL_REGEX.match(label):
+                raise ValidationError("Label '{}' is not valid. "
+                                      "Must be within [a-zA-Z0-9-].".format(label),
+                                      code='invalid')
         else:
             try:
-                idna.encode(label)
+                idna_encode_label(label)
             except idna.core.InvalidCodepoint as e:
                 raise ValidationError("Invalid label '{}': {}".format(label, e))
             except idna.core.IDNAError as e:
@@ -67,6 +67,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'mreg.middleware.MetricsMiddleware',
+    'mreg.middleware.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'mregsite.urls'
@@ -175,6 +177,62 @@ REST_FRAMEWORK_EXTENSIONS = {
         'rest_framework_extensions.utils.default_list_etag_func',
 }
 
+# Set to True to write the host history log from a background thread, instead
+# of when each transaction commits. Best-effort only: entries still queued are
+# lost if the process exits. See mreg.history.
+HOST_HISTORY_QUEUE = False
+
+# Cache used for the zonefiles rendered by the publish_zones management
+# command. Must name a CACHES backend shared by all processes, e.g.
+# memcached, for the zonefiles to be served from it. The default
+# LocMemCache is per process, so publish_zones does not fill it for the web
+# server. See mreg.publish.
+ZONEFILE_CACHE = 'default'
+
+# If set, zonefiles are published as files in this directory instead of in
+# the cache, keeping the ZONEFILE_ARTIFACT_KEEP latest versions of each zone.
+ZONEFILE_ARTIFACT_DIR = None
+ZONEFILE_ARTIFACT_KEEP = 5
+
+# Number of processes used by publish_zones to render zones concurrently.
+# Each uses a database connection.
+ZONEFILE_RENDER_WORKERS = 1
+
+# Cache used for authentication tokens, and the number of seconds a token is
+# cached. Should name a CACHES backend shared by all processes, e.g.
+# memcached, for a revoked token to be rejected at once by every process.
+# With the default per process LocMemCache, tokens and group memberships are
+# only cached for 5 seconds, and can be used that long after being revoked.
+# See mreg.authentication.
+TOKEN_CACHE = 'default'
+TOKEN_CACHE_TIMEOUT = 60
+
+# Number of seconds the group memberships of a user are cached, in the
+# TOKEN_CACHE. See mreg.api.permissions.
+GROUP_CACHE_TIMEOUT = 60
+
+# Addresses allowed to read /metrics. See mreg.metrics.
+METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+
+# Directory to save request profiles in, with the fraction of requests to
+# profile, and the number of seconds after which a request is slow enough to
+# be saved. See mreg.middleware.ProfilingMiddleware.
+PROFILE_DIR = None
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_SLOW_THRESHOLD = None
+
+# Maximum number of changes returned by /dhcphosts/changes.
+DHCP_CHANGES_LIMIT = 10000
+
+# Number of days to keep DHCP changes when running the prune_dhcp_changes
+# management command. Clients which have not read the changes for longer must
+# reload the full export.
+DHCP_CHANGES_RETENTION_DAYS = 30
+
+# Number of days to keep history entries when running the prune_history
+# management command.
+HISTORY_RETENTION_DAYS = 365
+
 # Django logging settings. To enable the default django request/response logging for API in stdout,
 # add "DISABLE_EXISTING_LOGGERS" = False
 DJANGO_LOGGING = {
@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.urls import include, path
 from mreg.api.v1 import views
+from mreg.metrics import metrics_view
 from rest_framework_swagger.views import get_swagger_view
 
 
@@ -13,5 +14,6 @@ urlpatterns = [
     path('api/', include('mreg.api.urls')),
     path('admin/', admin.site.urls),
     path('docs/', schema_view),
+    path('metrics', metrics_view),
 ]
 